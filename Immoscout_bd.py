@@ -1,115 +1,38 @@
-import requests
-import time
-import sqlite3
-from datetime import datetime, timezone
+import json
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime, timezone, timedelta
 from zoneinfo import ZoneInfo
 import os
 from dotenv import load_dotenv
 
-load_dotenv()
+from orchestrator import check_cancelled
+from metrics import timed
+from http_client import get_session
+from geocode import geocode_address
+from immoscout_auth import get_headers, token_manager
+from rate_limit import TokenBucket
+from storage import connect, release, filter_unseen, store_listings, get_meta, set_meta, write
 
-CLIENT_ID = os.getenv("IMMOSCOUT_CLIENT_ID")
-CLIENT_SECRET = os.getenv("IMMOSCOUT_CLIENT_SECRET")
+load_dotenv()
 
-DB_FILE = "seen_ids.db"
 BERLIN_TZ = ZoneInfo("Europe/Berlin")
 
+# Параллельная загрузка expose: число потоков и лимит запросов в секунду
+EXPOSE_CONCURRENCY = int(os.getenv("IMMOSCOUT_CONCURRENCY", "6"))
+EXPOSE_LIMITER = TokenBucket(rate=float(os.getenv("IMMOSCOUT_RATE", "5")),
+                             capacity=float(os.getenv("IMMOSCOUT_BURST", "5")))
 
-def init_db():
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-
-    # Создание таблицы, если её ещё нет
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS listings (
-            id TEXT PRIMARY KEY,
-            url TEXT,
-            price REAL,
-            price_warm REAL,
-            size REAL,
-            address TEXT,
-            lat REAL,
-            lon REAL,
-            swapflat INTEGER,
-            wbs_required INTEGER,
-            created_at TEXT,
-            source_immoscout INTEGER,
-            source_kleinanzeigen INTEGER,
-            source_immowelt INTEGER,
-            photo_url TEXT,
-            is_active TEXT,
-            last_checked TEXT,
-            source_wggesucht INTEGER,
-            source_inberlinwohnen INTEGER
-        )
-    """)
-
-    # 🔧 Добавление недостающих колонок
-    required_columns = {
-        "source_inberlinwohnen": "INTEGER DEFAULT 0",
-        "source_wggesucht": "INTEGER DEFAULT 0",
-        "source_immoscout": "INTEGER DEFAULT 0",
-        "source_kleinanzeigen": "INTEGER DEFAULT 0",
-        "source_immowelt": "INTEGER DEFAULT 0",
-        "photo_url": "TEXT",
-        "is_active": "TEXT",
-        "last_checked": "TEXT"
-    }
-
-    # Получаем текущие колонки
-    cursor.execute("PRAGMA table_info(listings)")
-    existing_columns = set(row[1] for row in cursor.fetchall())
-
-    for column_name, column_def in required_columns.items():
-        if column_name not in existing_columns:
-            try:
-                cursor.execute(f"ALTER TABLE listings ADD COLUMN {column_name} {column_def}")
-                print(f"🛠️ Добавлен столбец: {column_name}")
-            except sqlite3.OperationalError as e:
-                print(f"⚠️ Не удалось добавить колонку {column_name}: {e}")
-
-    conn.commit()
-    return conn, cursor
-
-
-
-
-def was_seen(cursor, obj_id):
-    cursor.execute("SELECT 1 FROM listings WHERE id = ?", (obj_id,))
-    return cursor.fetchone() is not None
-
-
-def mark_as_seen(conn, cursor, obj_id, listing):
-    cursor.execute("""
-        INSERT OR IGNORE INTO listings (
-            id, url, price, price_warm, size, address, lat, lon, swapflat,
-            wbs_required, created_at, source_immoscout, source_kleinanzeigen,
-            source_immowelt, photo_url, is_active, last_checked,
-            source_wggesucht, source_inberlinwohnen
-        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    """, (
-        obj_id,
-        listing["url"],
-        listing["price"],
-        listing["price_warm"],
-        listing["size"],
-        listing["address"],
-        listing["lat"],
-        listing["lon"],
-        int(listing["swapflat"]),
-        int(listing["wbs_required"]),
-        datetime.now(BERLIN_TZ).isoformat(timespec="seconds"),
-        1,  # source_immoscout
-        0,  # source_kleinanzeigen
-        0,  # source_immowelt
-        listing["photo_url"],
-        "1",
-        datetime.now(BERLIN_TZ).isoformat(timespec="seconds"),
-        0,  # source_wggesucht
-        0   # source_inberlinwohnen
-    ))
-    conn.commit()
-
+# Курсор поиска: до какого момента публикации всё уже просмотрено
+CURSOR_KEY = "immoscout_published_after"
+CURSOR_OVERLAP = int(os.getenv("IMMOSCOUT_CURSOR_OVERLAP", "120"))  # сек перекрытия между обходами
+MAX_CATCHUP = timedelta(hours=int(os.getenv("IMMOSCOUT_MAX_CATCHUP_HOURS", "24")))
+PAGE_SIZE = 30
+MAX_PAGES = int(os.getenv("IMMOSCOUT_MAX_PAGES", "20"))
+# Догоняющий обход, если новых больше MAX_PAGES страниц: с какой страницы продолжить
+CATCHUP_PAGE_KEY = "immoscout_catchup_page"
+# Expose, которые не удалось загрузить: ID -> число попыток; после EXPOSE_MAX_ATTEMPTS — бросаем
+RETRY_KEY = "immoscout_retry"
+EXPOSE_MAX_ATTEMPTS = int(os.getenv("IMMOSCOUT_MAX_ATTEMPTS", "3"))
 
 
 def clean_price_size(value):
@@ -130,21 +53,6 @@ def clean_price_size(value):
         return None
 
 
-def geocode_address(address):
-    try:
-        url = "https://nominatim.openstreetmap.org/search"
-        params = {"q": address, "format": "json", "addressdetails": 1, "limit": 1}
-        headers = {"User-Agent": "Mozilla/5.0 (compatible; ImmoScoutBot/1.0)"}
-        response = requests.get(url, params=params, headers=headers, timeout=10)
-        response.raise_for_status()
-        data = response.json()
-        if data:
-            return float(data[0]["lat"]), float(data[0]["lon"])
-    except Exception:
-        pass
-    return None, None
-
-
 def extract_warmmiete(data):
     for section in data.get("sections", []):
         if section.get("type") == "TOP_ATTRIBUTES":
@@ -180,138 +88,224 @@ def is_wbs_required(data):
     return False
 
 
-def get_token():
-    token_url = "https://publicauth.immobilienscout24.de/oauth/token"
-    params = {
-        "client_id": CLIENT_ID,
-        "grant_type": "client_credentials",
-        "client_secret": CLIENT_SECRET
-    }
-    response = requests.post(token_url, params=params)
-    response.raise_for_status()
-    return response.json()["access_token"]
+@timed("get_token", "Immoscout")
+def get_auth_headers():
+    """Заголовки с токеном из общего кэша (сеть — только если токен истёк)"""
+    return get_headers()
+
+
+def load_published_after(cursor):
+    """Отметка, начиная с которой ещё не всё просмотрено (сохраняется между запусками)"""
+    value = get_meta(cursor, CURSOR_KEY)
+    now = datetime.now(timezone.utc)
+    if not value:
+        return now - timedelta(seconds=CURSOR_OVERLAP)
+    # После долгого простоя догоняем не дальше MAX_CATCHUP
+    return max(datetime.fromisoformat(value), now - MAX_CATCHUP)
+
 
+def save_published_after(moment):
+    # Ждать записи не нужно: отстающая отметка лишь повторит часть обхода
+    write(set_meta, CURSOR_KEY, moment.isoformat(timespec="seconds"))
 
-def get_new_ids(headers, published_after):
-    print(f"📌 Поиск новых объявлений после {datetime.now(BERLIN_TZ).strftime('%Y-%m-%d %H:%M:%S')} (Берлинское время)")
+
+@timed("get_new_ids", "Immoscout")
+def get_new_ids(headers, published_after, first_page=1, oldest_first=False):
+    """ID, опубликованные после published_after: листаем страницы, пока они полные.
+
+    Не больше MAX_PAGES страниц начиная с first_page; возвращает (ids, дошли ли до конца).
+    """
+    print(f"📌 Поиск новых объявлений после {published_after.astimezone(BERLIN_TZ).strftime('%Y-%m-%d %H:%M:%S')} (Берлинское время)")
     url = "https://api.mobile.immobilienscout24.de/search/map/v3"
-    params = {
-        "geocodes": "/de",
-        "realEstateType": "apartmentrent",
-        "searchType": "region",
-        "sorting": "-firstactivation",
-        "pagesize": 30,
-        "pagenumber": 1,
-        "publishedafter": published_after
-    }
-    resp = requests.get(url, headers=headers, params=params)
-    resp.raise_for_status()
-    markers = resp.json().get("markers", [])
-    ids = [obj["id"] for marker in markers for obj in marker.get("objects", [])]
+    ids = []
+    complete = False
+    for page in range(first_page, first_page + MAX_PAGES):
+        check_cancelled()
+        params = {
+            "geocodes": "/de",
+            "realEstateType": "apartmentrent",
+            "searchType": "region",
+            "sorting": "firstactivation" if oldest_first else "-firstactivation",
+            "pagesize": PAGE_SIZE,
+            "pagenumber": page,
+            "publishedafter": published_after.isoformat(timespec="seconds")
+        }
+        resp = get_session().get(url, headers=headers, params=params)
+        if resp.status_code == 401:
+            token_manager.invalidate()
+        resp.raise_for_status()
+        markers = resp.json().get("markers", [])
+        page_ids = [obj["id"] for marker in markers for obj in marker.get("objects", [])]
+        ids.extend(page_ids)
+        if len(page_ids) < PAGE_SIZE:
+            complete = True
+            break
+    else:
+        print(f"⚠️ Достигнут лимит в {MAX_PAGES} страниц — продолжим со страницы {page} в следующем запуске")
+
+    # На стыке страниц одно объявление может встретиться дважды
+    ids = list(dict.fromkeys(ids))
     print(f"✅ Найдено {len(ids)} новых объектов: {ids}")
-    return ids
+    return ids, complete
+
+
+def load_retry(cursor):
+    value = get_meta(cursor, RETRY_KEY)
+    return json.loads(value) if value else {}
+
+
+def save_retry(retry, failed_ids, stored_ids):
+    """Учитывает попытки: неудачные — +1 (после EXPOSE_MAX_ATTEMPTS забываем), сохранённые — убираем"""
+    for obj_id in stored_ids:
+        retry.pop(obj_id, None)
+    for obj_id in failed_ids:
+        retry[obj_id] = retry.get(obj_id, 0) + 1
+        if retry[obj_id] >= EXPOSE_MAX_ATTEMPTS:
+            print(f"🚫 ID {obj_id}: {retry.pop(obj_id)} неудачных попыток — больше не пробуем")
+    write(set_meta, RETRY_KEY, json.dumps(retry))
+
+
+def fetch_expose(headers, obj_id):
+    """Загружает и разбирает один expose (выполняется в пуле потоков)"""
+    url = f"https://api.mobile.immobilienscout24.de/expose/{obj_id}?adType=RENT"
+    EXPOSE_LIMITER.acquire()
+    response = get_session().get(url, headers=headers)
+    if response.status_code == 401:
+        # Кэшированный токен отозван или истёк раньше срока: сбрасываем и повторяем с новым
+        token_manager.invalidate()
+        EXPOSE_LIMITER.acquire()
+        response = get_session().get(url, headers=get_headers())
+    response.raise_for_status()
+    data = response.json()
+
+    # Получаем фото (сохраняем в БД, но не выводим в логах)
+    media_section = next((s for s in data.get("sections", []) if s.get("type") == "MEDIA"), {})
+    photo_urls = [
+                     m.get("fullImageUrl")
+                     for m in media_section.get("media", [])
+                     if m.get("type") == "PICTURE" and m.get("fullImageUrl")
+                 ][:5]
+
+    # Получаем адрес и координаты
+    addr_section = next((s for s in data.get("sections", []) if s.get("type") == "MAP"), {})
+    address = addr_section.get("addressLine1", "") + ", " + addr_section.get("addressLine2", "")
+    lat = addr_section.get("location", {}).get("lat")
+    lon = addr_section.get("location", {}).get("lng")
+
+    if not lat or not lon:
+        if "Die vollständige Adresse" in address:
+            parts = address.split(",", 1)
+            if len(parts) > 1:
+                address = parts[1].strip()
+        lat, lon = geocode_address(address, "Immoscout")
+        if lat and lon:
+            print(f"🌍 Координаты найдены для адреса: '{address}'")
+
+    # Получаем атрибуты
+    attr_section = next((s for s in data.get("sections", []) if s.get("type") == "TOP_ATTRIBUTES"), {})
+    price_raw = next((a["text"] for a in attr_section.get("attributes", []) if "€" in a.get("text", "")), None)
+    size_raw = next((a["text"] for a in attr_section.get("attributes", []) if "m²" in a.get("text", "")), None)
+
+    return {
+        "url": f"https://www.immobilienscout24.de/expose/{obj_id}",
+        "price": clean_price_size(price_raw),
+        "price_warm": extract_warmmiete(data),
+        "size": clean_price_size(size_raw),
+        "address": address,
+        "lat": lat,
+        "lon": lon,
+        "swapflat": is_swapflat(data),
+        "wbs_required": is_wbs_required(data),
+        "photo_url": ",".join(photo_urls)
+    }
 
 
-def get_expose_details(headers, ids, cursor, conn):
+@timed("get_expose_details", "Immoscout")
+def get_expose_details(headers, ids):
+    """Параллельно загружает expose и сохраняет объявления, как только они готовы.
+
+    Всё, что завершилось к очередному пробуждению, пишется одной транзакцией.
+    Возвращает (ID сохранённых, ID с ошибкой).
+    """
     count = 0
-    new_ids = ids  # Обрабатываем все объявления
-
-    for obj_id in new_ids:
-        try:
-            url = f"https://api.mobile.immobilienscout24.de/expose/{obj_id}?adType=RENT"
-            response = requests.get(url, headers=headers)
-            response.raise_for_status()
-            data = response.json()
-
-            # Получаем фото (сохраняем в БД, но не выводим в логах)
-            media_section = next((s for s in data.get("sections", []) if s.get("type") == "MEDIA"), {})
-            photo_urls = [
-                             m.get("fullImageUrl")
-                             for m in media_section.get("media", [])
-                             if m.get("type") == "PICTURE" and m.get("fullImageUrl")
-                         ][:5]
-
-            # Получаем адрес и координаты
-            addr_section = next((s for s in data.get("sections", []) if s.get("type") == "MAP"), {})
-            address = addr_section.get("addressLine1", "") + ", " + addr_section.get("addressLine2", "")
-            lat = addr_section.get("location", {}).get("lat")
-            lon = addr_section.get("location", {}).get("lng")
-
-            if not lat or not lon:
-                if "Die vollständige Adresse" in address:
-                    parts = address.split(",", 1)
-                    if len(parts) > 1:
-                        address = parts[1].strip()
-                lat, lon = geocode_address(address)
-                if lat and lon:
-                    print(f"🌍 Координаты найдены для адреса: '{address}'")
-                time.sleep(1)
-
-            # Получаем атрибуты
-            attr_section = next((s for s in data.get("sections", []) if s.get("type") == "TOP_ATTRIBUTES"), {})
-            price_raw = next((a["text"] for a in attr_section.get("attributes", []) if "€" in a.get("text", "")), None)
-            size_raw = next((a["text"] for a in attr_section.get("attributes", []) if "m²" in a.get("text", "")), None)
-
-            price = clean_price_size(price_raw)
-            size = clean_price_size(size_raw)
-            price_warm = extract_warmmiete(data)
-
-            swapflat = is_swapflat(data)
-            wbs_required = is_wbs_required(data)
-
-            listing = {
-                "url": f"https://www.immobilienscout24.de/expose/{obj_id}",
-                "price": price,
-                "price_warm": price_warm,
-                "size": size,
-                "address": address,
-                "lat": lat,
-                "lon": lon,
-                "swapflat": swapflat,
-                "wbs_required": wbs_required,
-                "photo_url": ",".join(photo_urls)
-            }
-
-            # Создаем упрощенную версию для логов без URL фото
-            log_listing = listing.copy()
-            log_listing["photo_url"] = f"{len(photo_urls)} photos" if photo_urls else "no photos"
-
-            count += 1
-            print(f"{count}. 🏠 {log_listing}")
-            mark_as_seen(conn, cursor, obj_id, listing)
-            time.sleep(0.3)
-        except Exception as e:
-            print(f"⚠️ Ошибка при обработке ID {obj_id}: {str(e)}")
-
-    return count > 0
+    stored_ids = []
+    failed_ids = []
+    executor = ThreadPoolExecutor(max_workers=EXPOSE_CONCURRENCY, thread_name_prefix="expose")
+    try:
+        pending = {executor.submit(fetch_expose, headers, obj_id): obj_id for obj_id in ids}
+        while pending:
+            check_cancelled()
+            done, _ = wait(pending, timeout=1, return_when=FIRST_COMPLETED)
+            batch = []
+            for future in done:
+                obj_id = pending.pop(future)
+                try:
+                    listing = future.result()
+                    listing["id"] = obj_id
+
+                    # Создаем упрощенную версию для логов без URL фото
+                    log_listing = listing.copy()
+                    photo_count = len(listing["photo_url"].split(",")) if listing["photo_url"] else 0
+                    log_listing["photo_url"] = f"{photo_count} photos" if photo_count else "no photos"
+
+                    count += 1
+                    print(f"{count}. 🏠 {log_listing}")
+                    batch.append(listing)
+                    stored_ids.append(obj_id)
+                except Exception as e:
+                    failed_ids.append(obj_id)
+                    print(f"⚠️ Ошибка при обработке ID {obj_id}: {str(e)}")
+            store_listings("Immoscout", batch)
+    finally:
+        # При отмене не ждём оставшиеся запросы
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    return stored_ids, failed_ids
 
 
 def run():
-    conn, cursor = init_db()
+    conn = connect()
+    cursor = conn.cursor()
     try:
-        token = get_token()
-        headers = {
-            "Authorization": f"Bearer {token}",
-            "User-Agent": "ImmoScout_26.19.3_18.1.1_._",
-            "Accept": "application/json",
-            "x-is24-device": "iphone",
-            "x_is24_client_id": "65E7AE2B87FF46FBB44649D55E68687E"
-        }
+        headers = get_auth_headers()
 
-        published_after = datetime.now(timezone.utc).isoformat(timespec="seconds")
-        ids = get_new_ids(headers, published_after)
-
-        if ids:
-            return get_expose_details(headers, ids, cursor, conn)
+        sweep_started = datetime.now(timezone.utc)
+        published_after = load_published_after(cursor)
+        catchup_page = int(get_meta(cursor, CATCHUP_PAGE_KEY) or 0)
+        if catchup_page:
+            new_ids, complete = get_new_ids(headers, published_after, catchup_page, oldest_first=True)
         else:
+            new_ids, complete = get_new_ids(headers, published_after)
+
+        # Неудавшиеся expose прошлых запусков пробуем вместе с новыми; курсор они не держат
+        retry = load_retry(cursor)
+        ids = filter_unseen(cursor, "Immoscout", list(dict.fromkeys(new_ids + list(retry))))
+        retry = {obj_id: attempts for obj_id, attempts in retry.items() if obj_id in ids}
+
+        stored_ids, failed_ids = get_expose_details(headers, ids) if ids else ([], [])
+        if not ids:
             print("🔍 Новых объявлений пока нет.")
-            return False
+        if retry or failed_ids:
+            save_retry(retry, failed_ids, stored_ids)
+
+        if complete:
+            # Дошли до отметки: сдвигаем её на начало обхода (с запасом на задержку индексации)
+            save_published_after(sweep_started - timedelta(seconds=CURSOR_OVERLAP))
+            if catchup_page:
+                write(set_meta, CATCHUP_PAGE_KEY, "")
+        else:
+            # Не дошли: отметку не трогаем, а остаток догоняем от старых к новым — новые
+            # объявления добавляются в конец, и номера страниц не съезжают. Одна страница
+            # внахлёст — на случай снятых с публикации
+            next_page = catchup_page + max(MAX_PAGES - 1, 1) if catchup_page else 1
+            write(set_meta, CATCHUP_PAGE_KEY, next_page)
+        return bool(stored_ids)
 
     except Exception as e:
         print(f"🔥 Критическая ошибка: {str(e)}")
         return False
     finally:
-        conn.close()
+        release(conn)
 
 
 if __name__ == "__main__":
@@ -1,13 +1,14 @@
 # -*- coding: utf-8 -*-
-import requests
 import time
 import logging
-import sqlite3
 import os
-from datetime import datetime
-from zoneinfo import ZoneInfo
 from dotenv import load_dotenv
 
+from orchestrator import check_cancelled
+from metrics import timed
+from http_client import get_named_session
+from storage import connect, release, filter_unseen, store_listings
+
 # === Загрузка .env ===
 load_dotenv()
 
@@ -22,81 +23,7 @@ logging.basicConfig(
     ]
 )
 
-# === Константы ===
-BERLIN_TZ = ZoneInfo("Europe/Berlin")
-DB_FILE = os.getenv("DB_FILE", "seen_ids.db")
-
 # === Вспомогательные функции ===
-def init_db():
-    """Создаёт БД и таблицу listings при необходимости"""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS listings (
-            id TEXT PRIMARY KEY,
-            url TEXT,
-            price REAL,
-            price_warm REAL,
-            size REAL,
-            address TEXT,
-            lat REAL,
-            lon REAL,
-            swapflat INTEGER,
-            wbs_required INTEGER,
-            created_at TEXT,
-            source_immoscout INTEGER,
-            source_kleinanzeigen INTEGER,
-            source_immowelt INTEGER,
-            photo_url TEXT,
-            is_active TEXT,
-            last_checked TEXT,
-            source_wggesucht INTEGER,
-            source_inberlinwohnen INTEGER
-        )
-    """)
-    conn.commit()
-    return conn, cursor
-
-
-def was_seen(cursor, obj_id: str) -> bool:
-    """Проверяет, есть ли объект с таким id в базе"""
-    cursor.execute("SELECT 1 FROM listings WHERE id = ?", (obj_id,))
-    return cursor.fetchone() is not None
-
-
-def mark_as_seen(conn, cursor, obj_id: str, listing: dict):
-    """Сохраняет объявление в базу"""
-    cursor.execute("""
-        INSERT OR IGNORE INTO listings (
-            id, url, price, price_warm, size, address, lat, lon, swapflat,
-            wbs_required, created_at, source_immoscout, source_kleinanzeigen,
-            source_immowelt, photo_url, is_active, last_checked,
-            source_wggesucht, source_inberlinwohnen
-        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    """, (
-        obj_id,
-        listing["url"],
-        listing["price"],
-        listing["price_warm"],
-        listing["size"],
-        listing["address"],
-        listing["lat"],
-        listing["lon"],
-        int(listing["swapflat"]),
-        int(listing["wbs_required"]),
-        datetime.now(BERLIN_TZ).isoformat(timespec="seconds"),
-        0,  # source_immoscout
-        0,  # source_kleinanzeigen
-        1,  # source_immowelt
-        listing["photo_url"],
-        "1",
-        datetime.now(BERLIN_TZ).isoformat(timespec="seconds"),
-        0,  # source_wggesucht
-        0   # source_inberlinwohnen
-    ))
-    conn.commit()
-
-
 def clean_price_size(value: str):
     """Парсинг цены/площади из строки"""
     if not value:
@@ -113,10 +40,8 @@ def clean_price_size(value: str):
 class ImmoweltScraper:
     def __init__(self):
         """Создаёт сессию и заголовки"""
-        self.session = requests.Session()
-        proxy = os.getenv("IMMO_PROXY")
-        if proxy:
-            self.session.proxies = {"http": proxy, "https": proxy}
+        # Своя сессия: у Immowelt отдельный прокси и cookie DataDome; одна на процесс
+        self.session = get_named_session("immowelt", proxy=os.getenv("IMMO_PROXY"))
 
         self.headers = {
             "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64)",
@@ -127,6 +52,7 @@ class ImmoweltScraper:
         }
         self.datadome_cookie = None
 
+    @timed("bypass_datadome", "Immowelt")
     def bypass_datadome(self) -> bool:
         """Пробует обойти защиту DataDome (placeholders вместо секретов)"""
         logging.info("Пытаемся обойти защиту DataDome...")
@@ -154,6 +80,7 @@ class ImmoweltScraper:
             logging.error(f"❌ Ошибка обхода DataDome: {e}")
         return False
 
+    @timed("search_listings", "Immowelt")
     def search_listings(self, page=1, size=30):
         """Ищет список объявлений"""
         url = "https://www.immowelt.de/serp-bff/search"
@@ -176,6 +103,7 @@ class ImmoweltScraper:
         logging.warning(f"⚠️ Не удалось получить страницу {page}")
         return None
 
+    @timed("get_listing_details", "Immowelt")
     def get_listing_details(self, listing_ids):
         """Подробности по объявлениям"""
         if not listing_ids:
@@ -188,11 +116,12 @@ class ImmoweltScraper:
         r = self.session.get(url, headers=headers)
         return r.json() if r.status_code == 200 else []
 
-    def parse_and_store_listing(self, listing, conn, cursor):
-        """Парсит объявление и сохраняет в базу"""
+    @timed("parse_listing", "Immowelt")
+    def parse_listing(self, listing):
+        """Парсит объявление из classifiedList"""
         obj_id = listing.get("id")
-        if not obj_id or was_seen(cursor, obj_id):
-            return
+        if not obj_id:
+            return None
 
         address_parts = listing.get("location", {}).get("address", {})
         address = ", ".join(filter(None, [
@@ -219,7 +148,8 @@ class ImmoweltScraper:
 
         url = listing.get("url") or f"https://www.immowelt.de/expose/{listing.get('metadata', {}).get('legacyId')}"
 
-        parsed = {
+        return {
+            "id": obj_id,
             "url": url,
             "price": price,
             "price_warm": None,
@@ -232,27 +162,37 @@ class ImmoweltScraper:
             "wbs_required": 0
         }
 
-        mark_as_seen(conn, cursor, obj_id, parsed)
-        logging.info(f"💾 Сохранено объявление: {obj_id}")
-
     def scrape(self, max_pages=1):
-        """Основной процесс скрапинга"""
+        """Основной процесс скрапинга; возвращает число сохранённых объявлений"""
         if not self.bypass_datadome():
-            return
-        conn, cursor = init_db()
+            return 0
+        conn = connect()
+        cursor = conn.cursor()
+        added = 0
         for page in range(1, max_pages + 1):
+            check_cancelled()
             result = self.search_listings(page=page)
             if not result:
                 continue
-            ids = [item["id"] for item in result.get("classifieds", [])]
+            # Подробности запрашиваем только для новых
+            ids = filter_unseen(cursor, "Immowelt", [item["id"] for item in result.get("classifieds", [])])
             details = self.get_listing_details(ids)
+            parsed = []
             for listing in details:
+                check_cancelled()
                 try:
-                    self.parse_and_store_listing(listing, conn, cursor)
+                    entry = self.parse_listing(listing)
+                    if entry:
+                        parsed.append(entry)
                 except Exception as e:
                     logging.warning(f"⚠️ Ошибка при обработке: {e}")
+            # Вся страница — одной транзакцией
+            for obj_id in store_listings("Immowelt", parsed):
+                logging.info(f"💾 Сохранено объявление: {obj_id}")
+                added += 1
             time.sleep(1.5)
-        conn.close()
+        release(conn)
+        return added
 
 
 # === Запуск напрямую ===
@@ -264,5 +204,4 @@ if __name__ == "__main__":
 # === Запуск через импорт (в проекте) ===
 def run():
     scraper = ImmoweltScraper()
-    scraper.scrape(max_pages=1)
-    return True
+    return scraper.scrape(max_pages=1) > 0
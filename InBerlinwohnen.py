@@ -1,15 +1,16 @@
 # -*- coding: utf-8 -*-
-import requests
 import re
-import time
-import sqlite3
 import logging
 import os
-from datetime import datetime
 from bs4 import BeautifulSoup
-from zoneinfo import ZoneInfo
 from dotenv import load_dotenv
 
+from orchestrator import check_cancelled
+from metrics import timed
+from http_client import get_session
+from geocode import geocode_address
+from storage import connect, release, filter_unseen, store_listings
+
 # === Загрузка .env ===
 load_dotenv()
 
@@ -25,91 +26,11 @@ logging.basicConfig(
 )
 
 # === Константы ===
-DB_FILE = os.getenv("DB_FILE", "seen_ids.db")
-BERLIN_TZ = ZoneInfo("Europe/Berlin")
 BASE_URL = "https://inberlinwohnen.de/"
+HTML_PARSER = os.getenv("HTML_PARSER", "html.parser")
 
-# === Работа с БД ===
-def init_db():
-    """Создание базы и таблицы listings при необходимости"""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS listings (
-            id TEXT PRIMARY KEY,
-            url TEXT,
-            price REAL,
-            price_warm REAL,
-            size REAL,
-            address TEXT,
-            lat REAL,
-            lon REAL,
-            swapflat INTEGER,
-            wbs_required INTEGER,
-            created_at TEXT,
-            source_immoscout INTEGER,
-            source_kleinanzeigen INTEGER,
-            source_immowelt INTEGER,
-            photo_url TEXT,
-            is_active TEXT,
-            last_checked TEXT,
-            source_wggesucht INTEGER,
-            source_inberlinwohnen INTEGER
-        )
-    """)
-    conn.commit()
-    return conn, cursor
-
-
-def mark_as_seen(conn, cursor, obj_id, listing):
-    """Сохраняет объявление в БД"""
-    cursor.execute("""
-        INSERT OR IGNORE INTO listings (
-            id, url, price, price_warm, size, address, lat, lon, swapflat,
-            wbs_required, created_at, source_immoscout, source_kleinanzeigen,
-            source_immowelt, photo_url, is_active, last_checked,
-            source_wggesucht, source_inberlinwohnen
-        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    """, (
-        obj_id,
-        listing["url"],
-        listing["price"],
-        None,
-        listing["size"],
-        listing["address"],
-        listing["lat"],
-        listing["lon"],
-        0,
-        int(listing["wbs_required"]),
-        datetime.now(BERLIN_TZ).isoformat(timespec="seconds"),
-        0, 0, 0,
-        listing["photo_url"],
-        "1",
-        datetime.now(BERLIN_TZ).isoformat(timespec="seconds"),
-        0,
-        1
-    ))
-    conn.commit()
 
 # === Вспомогательные функции ===
-def geocode_address(address):
-    """Получает координаты по адресу через OpenStreetMap"""
-    try:
-        url = "https://nominatim.openstreetmap.org/search"
-        params = {"q": address, "format": "json", "limit": 1}
-        headers = {"User-Agent": "Mozilla/5.0 (compatible; InBerlinBot/1.0)"}
-        response = requests.get(url, params=params, headers=headers, timeout=10)
-        response.raise_for_status()
-        data = response.json()
-        if data:
-            lat = float(data[0]["lat"])
-            lon = float(data[0]["lon"])
-            return lat, lon
-    except Exception:
-        pass
-    return None, None
-
-
 def clean_price_size(value):
     """Преобразует строку с ценой или площадью в float"""
     if not value:
@@ -128,7 +49,8 @@ def is_wbs_required(text: str) -> bool:
     return ("wbs" in text and "ohne" not in text) or "wohnberechtigungsschein" in text
 
 
-def fetch_inberlin_listings(seen_ids):
+@timed("fetch_inberlin_listings", "InBerlinWohnen")
+def fetch_inberlin_listings(cursor):
     """Забирает новые объявления с сайта InBerlinWohnen"""
     url = "https://inberlinwohnen.de/wp-content/themes/ibw/skript/wohnungsfinder.php"
     headers = {
@@ -140,22 +62,21 @@ def fetch_inberlin_listings(seen_ids):
     }
     data = {"q": "wf-save-srch", "save": "false", "wbs": "all"}
 
-    response = requests.post(url, headers=headers, data=data, timeout=15)
+    response = get_session().post(url, headers=headers, data=data, timeout=15)
     response.raise_for_status()
     json_data = response.json()
 
     html = json_data.get("searchresults", "")
-    soup = BeautifulSoup(html, "html.parser")
-    flats = soup.select("li.tb-merkflat")
+    soup = BeautifulSoup(html, HTML_PARSER)
+    flats = {}
+    for flat in soup.select("li.tb-merkflat"):
+        raw_id = flat.get("id", "")
+        if raw_id:
+            flats[raw_id.replace("flat_", "").strip()] = flat
 
     listings = []
-    for flat in flats:
-        raw_id = flat.get("id", "")
-        if not raw_id:
-            continue
-        flat_id = raw_id.replace("flat_", "").strip()
-        if flat_id in seen_ids:
-            continue
+    for flat_id in filter_unseen(cursor, "InBerlinWohnen", flats):
+        flat = flats[flat_id]
 
         title_tag = flat.select_one("h3 span._tb_left")
         address_tag = flat.select_one("table.tb-small-data a.map-but")
@@ -196,30 +117,31 @@ def fetch_inberlin_listings(seen_ids):
 # === Основной запуск ===
 def run():
     """Основной процесс: загрузка объявлений и сохранение в БД"""
-    conn, cursor = init_db()
+    conn = connect()
+    cursor = conn.cursor()
     try:
-        cursor.execute("SELECT id FROM listings")
-        seen_ids = set(row[0] for row in cursor.fetchall())
+        listings = fetch_inberlin_listings(cursor)
 
-        listings = fetch_inberlin_listings(seen_ids)
+        # Сохраняем каждую квартиру сразу после геокодирования: прерванный по дедлайну
+        # запуск не теряет уже обработанные, а рассылка получает их без ожидания всей пачки
         added_count = 0
-
         for listing in listings:
-            lat, lon = geocode_address(listing["address"])
+            check_cancelled()
+            lat, lon = geocode_address(listing["address"], "InBerlinWohnen")
             listing["lat"] = lat
             listing["lon"] = lon
-            time.sleep(1)  # не перегружаем API
 
-        for listing in listings:
-            mark_as_seen(conn, cursor, listing["id"], listing)
-            added_count += 1
-            logging.info(f"💾 Добавлено: {listing['id']}")
+            for obj_id in store_listings("InBerlinWohnen", [listing]):
+                logging.info(f"💾 Добавлено: {obj_id}")
+                added_count += 1
 
         logging.info(f"✅ Всего добавлено: {added_count}")
+        return added_count > 0
     except Exception as e:
         logging.error(f"🔥 Ошибка выполнения: {str(e)}")
+        return False
     finally:
-        conn.close()
+        release(conn)
 
 
 if __name__ == "__main__":
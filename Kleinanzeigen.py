@@ -1,15 +1,17 @@
 # -*- coding: utf-8 -*-
-import requests
-import sqlite3
 import re
-import datetime
 import time
 import logging
 import os
 from bs4 import BeautifulSoup
-from zoneinfo import ZoneInfo
 from dotenv import load_dotenv
 
+from orchestrator import check_cancelled
+from metrics import timed
+from http_client import get_session
+from geocode import geocode_address
+from storage import connect, release, filter_unseen, store_listings
+
 # === Загрузка .env ===
 load_dotenv()
 
@@ -25,104 +27,21 @@ logging.basicConfig(
 )
 
 # === Константы ===
-DB_FILE = os.getenv("DB_FILE", "seen_ids.db")
-BERLIN_TZ = ZoneInfo("Europe/Berlin")
 BASE_URL = "https://www.kleinanzeigen.de/s-wohnung-mieten/berlin/c203+wohnung_mieten.swap_s:nein"
+HTML_PARSER = os.getenv("HTML_PARSER", "html.parser")
 
-# === Работа с БД ===
-def init_db():
-    """Создание базы и таблицы listings при необходимости"""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS listings (
-            id TEXT PRIMARY KEY,
-            url TEXT,
-            price REAL,
-            price_warm REAL,
-            size REAL,
-            address TEXT,
-            lat REAL,
-            lon REAL,
-            swapflat INTEGER,
-            wbs_required INTEGER,
-            created_at TEXT,
-            source_immoscout INTEGER,
-            source_kleinanzeigen INTEGER,
-            source_immowelt INTEGER,
-            photo_url TEXT,
-            is_active TEXT,
-            last_checked TEXT,
-            source_wggesucht INTEGER,
-            source_inberlinwohnen INTEGER
-        )
-    """)
-    conn.commit()
-    return conn, cursor
-
-
-def was_seen(cursor, obj_id: str) -> bool:
-    cursor.execute("SELECT 1 FROM listings WHERE id = ?", (obj_id,))
-    return cursor.fetchone() is not None
-
-
-def mark_as_seen(conn, cursor, obj_id: str, listing: dict):
-    cursor.execute("""
-        INSERT OR IGNORE INTO listings (
-            id, url, price, price_warm, size, address, lat, lon, swapflat,
-            wbs_required, created_at, source_immoscout, source_kleinanzeigen,
-            source_immowelt, photo_url, is_active, last_checked,
-            source_wggesucht, source_inberlinwohnen
-        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    """, (
-        obj_id,
-        listing["url"],
-        listing["price"],
-        listing["price_warm"],
-        listing["size"],
-        listing["address"],
-        listing["lat"],
-        listing["lon"],
-        int(listing["swapflat"]),
-        int(listing["wbs_required"]),
-        datetime.datetime.now(BERLIN_TZ).isoformat(timespec="seconds"),
-        0,  # source_immoscout
-        1,  # source_kleinanzeigen
-        0,  # source_immowelt
-        listing["photo_url"],
-        "1",
-        datetime.datetime.now(BERLIN_TZ).isoformat(timespec="seconds"),
-        0,  # source_wggesucht
-        0   # source_inberlinwohnen
-    ))
-    conn.commit()
 
 # === Вспомогательные функции ===
-def geocode_address(address):
-    """Получает координаты по адресу через OpenStreetMap"""
-    try:
-        url = "https://nominatim.openstreetmap.org/search"
-        params = {"q": address, "format": "json", "addressdetails": 1, "limit": 1}
-        headers = {"User-Agent": "Mozilla/5.0 (compatible; KleinanzeigenBot/1.0)"}
-        response = requests.get(url, params=params, headers=headers, timeout=10)
-        response.raise_for_status()
-        data = response.json()
-        if data:
-            return float(data[0]["lat"]), float(data[0]["lon"])
-    except Exception:
-        pass
-    return None, None
-
-
+@timed("fetch_html", "Kleinanzeigen")
 def fetch_html(url):
     headers = {
         "User-Agent": "Mozilla/5.0 (compatible; KleinanzeigenBot/1.0)",
         "Accept-Language": "de-DE,de;q=0.9,en-US;q=0.8,en;q=0.7"
     }
     try:
-        response = requests.get(url, headers=headers, timeout=10)
+        response = get_session().get(url, headers=headers, timeout=10)
         response.raise_for_status()
-        return BeautifulSoup(response.text, "html.parser")
+        return BeautifulSoup(response.text, HTML_PARSER)
     except Exception as e:
         logging.error(f"❌ Ошибка при запросе {url}: {e}")
         return None
@@ -155,26 +74,32 @@ def extract_warmmiete_from_soup(soup):
     return kalt
 
 
-def extract_data(soup):
-    """Парсит список объявлений со страницы"""
+@timed("extract_data", "Kleinanzeigen")
+def extract_data(soup, cursor):
+    """Парсит список объявлений со страницы; возвращает сохранённые новые.
+
+    Каждое объявление сохраняется сразу после геокода и деталей: прерванный по
+    дедлайну запуск не теряет уже обработанные, а рассылка получает их без
+    ожидания всей страницы.
+    """
     entries = []
     container = soup.find(id="srchrslt-adtable")
     if not container:
         logging.warning("⚠️ srchrslt-adtable не найден — структура сайта изменилась?")
         return entries
 
-    exposes = container.find_all("article", class_="aditem")
-    for expose in exposes:
+    candidates = {}
+    for expose in container.find_all("article", class_="aditem"):
         title_elem = expose.find(class_="ellipsis")
-        if not title_elem or not title_elem.get("href"):
-            continue
-        url = "https://www.kleinanzeigen.de" + title_elem.get("href")
-
         obj_id = expose.get("data-adid")
-        if not obj_id:
-            continue
-        if was_seen(cursor, obj_id):
-            continue
+        if title_elem and title_elem.get("href") and obj_id:
+            candidates[obj_id] = (expose, title_elem)
+
+    # Одна проверка на всю страницу; детали и геокод — только для новых
+    for obj_id in filter_unseen(cursor, "Kleinanzeigen", candidates):
+        check_cancelled()
+        expose, title_elem = candidates[obj_id]
+        url = "https://www.kleinanzeigen.de" + title_elem.get("href")
 
         try:
             price_text = expose.find(class_="aditem-main--middle--price-shipping--price").text.strip()
@@ -191,7 +116,7 @@ def extract_data(soup):
         except Exception:
             continue
 
-        lat, lon = geocode_address(address)
+        lat, lon = geocode_address(address, "Kleinanzeigen")
         soup_detail = fetch_html(url)
         images, price_warm = [], None
         if soup_detail:
@@ -217,12 +142,16 @@ def extract_data(soup):
             "wbs_required": False,
             "photo_url": ",".join(images),
         }
-        entries.append(entry)
+        if store_listings("Kleinanzeigen", [entry]):
+            logging.info(f"🏠 {entry['address']} | {entry['price']}€ | {entry['size']} m² | Warmmiete: {entry.get('price_warm')}")
+            logging.info(f"   🔗 {entry['url']}")
+            entries.append(entry)
     return entries
 
 # === Основной процесс ===
 def run(url=None):
-    conn, cursor = init_db()
+    conn = connect()
+    cursor = conn.cursor()
     try:
         url = url or BASE_URL
         soup = fetch_html(url)
@@ -230,20 +159,7 @@ def run(url=None):
             logging.error("❌ Не удалось получить HTML")
             return False
 
-        entries = extract_data(soup)
-        if not entries:
-            logging.warning("⚠️ Объявления не найдены")
-            return False
-
-        new_entries = 0
-        for entry in entries:
-            if was_seen(cursor, entry["id"]):
-                continue
-            new_entries += 1
-            mark_as_seen(conn, cursor, entry["id"], entry)
-            logging.info(f"🏠 {entry['address']} | {entry['price']}€ | {entry['size']} m² | Warmmiete: {entry.get('price_warm')}")
-            logging.info(f"   🔗 {entry['url']}")
-
+        new_entries = len(extract_data(soup, cursor))
         if new_entries == 0:
             logging.info("📬 Новых объявлений нет")
         else:
@@ -253,7 +169,7 @@ def run(url=None):
         logging.error(f"🔥 Критическая ошибка: {e}")
         return False
     finally:
-        conn.close()
+        release(conn)
 
 
 if __name__ == "__main__":
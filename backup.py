@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""Снимки seen_ids.db на ходу, без остановки парсеров и бота.
+
+Копирует online backup API SQLite небольшими шагами по BACKUP_PAGES страниц
+с паузой между ними. База в WAL, так что копирование идёт из одного снимка
+чтения: писатели его не ждут, а сам backup не перезапускается от их коммитов.
+Снимок сжимается в BACKUP_DIR, хранятся последние BACKUP_KEEP.
+
+    python backup.py snapshot     # снять снимок сейчас
+    python backup.py list         # какие снимки есть
+    python backup.py restore      # восстановить последний (или указать файл снимка)
+"""
+import gzip
+import logging
+import os
+import shutil
+import sqlite3
+import time
+from datetime import datetime
+from dotenv import load_dotenv
+
+import storage
+from metrics import record
+
+# === Загрузка .env ===
+load_dotenv()
+
+# === Константы ===
+BACKUP_DIR = os.getenv("BACKUP_DIR", "backups")
+BACKUP_INTERVAL = int(os.getenv("BACKUP_INTERVAL", str(6 * 3600)))  # сек между снимками
+BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", "14"))
+BACKUP_PAGES = int(os.getenv("BACKUP_PAGES", "256"))  # страниц за шаг (по 4 КиБ)
+BACKUP_STEP_SLEEP = float(os.getenv("BACKUP_STEP_SLEEP", "0.05"))  # пауза между шагами, сек
+SNAPSHOT_SUFFIX = ".db.gz"
+
+
+def _snapshot_prefix(db_path):
+    return os.path.splitext(os.path.basename(db_path))[0] + "-"
+
+
+def list_snapshots(db_path=None, backup_dir=BACKUP_DIR):
+    """Снимки базы, от старых к новым (имя содержит время, сортировка по имени)"""
+    prefix = _snapshot_prefix(db_path or storage.DB_FILE)
+    if not os.path.isdir(backup_dir):
+        return []
+    return sorted(os.path.join(backup_dir, name) for name in os.listdir(backup_dir)
+                  if name.startswith(prefix) and name.endswith(SNAPSHOT_SUFFIX))
+
+
+def _check_sqlite_backend():
+    if storage.STORAGE_BACKEND != "sqlite":
+        raise RuntimeError(f"Снимки делаются только для SQLite; для {storage.STORAGE_BACKEND} используйте pg_dump")
+
+
+def _copy_online(src, dst, pages):
+    """src.backup по шагам; статистика: шаги, перезапуски, время под блокировкой (сумма, максимум), сек"""
+    stats = {"steps": 0, "restarts": 0, "lock_total": 0.0, "lock_max": 0.0, "snapshot": 0.0}
+    wal = src.execute("PRAGMA journal_mode").fetchone()[0].lower() == "wal"
+    if wal:
+        # Держим одну транзакцию чтения на всё копирование. Без неё каждый коммит
+        # писателя перезапускает backup с начала, и при частой записи он не кончится.
+        # Читатель в WAL писателям не мешает — ждёт только checkpoint
+        src.execute("BEGIN")
+        src.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+    started = time.perf_counter()
+    last = {"at": started, "remaining": None}
+
+    def progress(status, remaining, total):
+        # Вызывается после каждого шага: время с прошлого вызова — сам шаг копирования
+        held = time.perf_counter() - last["at"]
+        stats["steps"] += 1
+        stats["lock_total"] += held
+        stats["lock_max"] = max(stats["lock_max"], held)
+        record("backup_step", "Storage", held)
+        # Источник изменили другим соединением — SQLite начинает копирование заново
+        if last["remaining"] is not None and remaining > last["remaining"]:
+            stats["restarts"] += 1
+        last["remaining"] = remaining
+        # sleep= у backup() срабатывает только на SQLITE_BUSY — паузу между шагами делаем сами
+        if remaining:
+            time.sleep(BACKUP_STEP_SLEEP)
+        last["at"] = time.perf_counter()
+
+    try:
+        src.backup(dst, pages=pages, progress=progress)
+    finally:
+        if wal:
+            src.rollback()
+            stats["snapshot"] = time.perf_counter() - started
+    return stats
+
+
+def create_snapshot(db_path=None, backup_dir=BACKUP_DIR, keep=BACKUP_KEEP, pages=BACKUP_PAGES):
+    """Снимает сжатый снимок базы и удаляет лишние старые; возвращает (путь, статистика)"""
+    _check_sqlite_backend()
+    db_path = db_path or storage.DB_FILE
+    os.makedirs(backup_dir, exist_ok=True)
+    name = f"{_snapshot_prefix(db_path)}{datetime.now().strftime('%Y%m%d-%H%M%S')}"
+    raw_path = os.path.join(backup_dir, name + ".db.part")
+    final_path = os.path.join(backup_dir, name + SNAPSHOT_SUFFIX)
+
+    started = time.perf_counter()
+    src = sqlite3.connect(db_path, timeout=storage.BUSY_TIMEOUT_MS / 1000)
+    dst = sqlite3.connect(raw_path)
+    try:
+        stats = _copy_online(src, dst, pages)
+        check = dst.execute("PRAGMA quick_check").fetchone()[0]
+        if check != "ok":
+            raise RuntimeError(f"Снимок повреждён: quick_check={check}")
+    finally:
+        dst.close()
+        src.close()
+
+    try:
+        # Сжимаем во временный файл: недописанный .gz не попадёт в список снимков
+        with open(raw_path, "rb") as raw, gzip.open(final_path + ".part", "wb", compresslevel=6) as packed:
+            shutil.copyfileobj(raw, packed)
+        os.replace(final_path + ".part", final_path)
+    finally:
+        os.remove(raw_path)
+
+    stats["seconds"] = time.perf_counter() - started
+    stats["bytes"] = os.path.getsize(final_path)
+    logging.info(
+        f"💾 Снимок {final_path}: {stats['bytes'] // 1024} КиБ за {stats['seconds']:.1f} с, "
+        f"блокировка {stats['lock_total'] * 1000:.0f} мс за {stats['steps']} шагов "
+        f"(макс. {stats['lock_max'] * 1000:.1f} мс), снимок чтения WAL {stats['snapshot'] * 1000:.0f} мс, "
+        f"перезапусков {stats['restarts']}"
+    )
+
+    for old in list_snapshots(db_path, backup_dir)[:-max(keep, 1)]:
+        os.remove(old)
+        logging.info(f"🗑️ Удалён старый снимок {old}")
+    return final_path, stats
+
+
+def restore_snapshot(snapshot_path, db_path=None):
+    """Восстанавливает базу из снимка.
+
+    Пишет в базу через тот же backup API, а не копированием файла: WAL и
+    блокировки остаются согласованными. Парсеры и бот лучше остановить —
+    всё, что они записали после снимка, будет потеряно.
+    """
+    _check_sqlite_backend()
+    db_path = db_path or storage.DB_FILE
+    raw_path = db_path + ".restore"
+    with gzip.open(snapshot_path, "rb") as packed, open(raw_path, "wb") as raw:
+        shutil.copyfileobj(packed, raw)
+    try:
+        src = sqlite3.connect(raw_path)
+        dst = sqlite3.connect(db_path, timeout=storage.BUSY_TIMEOUT_MS / 1000)
+        try:
+            check = src.execute("PRAGMA quick_check").fetchone()[0]
+            if check != "ok":
+                raise RuntimeError(f"Снимок повреждён: quick_check={check}")
+            src.backup(dst)
+            version = dst.execute("PRAGMA user_version").fetchone()[0]
+        finally:
+            dst.close()
+            src.close()
+    finally:
+        os.remove(raw_path)
+    logging.info(f"♻️ {db_path} восстановлена из {snapshot_path} (версия схемы {version})")
+    return version
+
+
+if __name__ == "__main__":
+    import argparse
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    parser = argparse.ArgumentParser(description="Снимки базы SQLite")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("snapshot", help="снять снимок сейчас")
+    sub.add_parser("list", help="показать снимки")
+    restore = sub.add_parser("restore", help="восстановить базу из снимка")
+    restore.add_argument("snapshot", nargs="?", help="файл снимка (по умолчанию — последний)")
+    args = parser.parse_args()
+
+    if args.command == "snapshot":
+        create_snapshot()
+    elif args.command == "list":
+        for path in list_snapshots():
+            print(f"{path}  {os.path.getsize(path) // 1024} КиБ")
+    else:
+        snapshots = list_snapshots()
+        path = args.snapshot or (snapshots[-1] if snapshots else None)
+        if not path:
+            parser.error(f"в {BACKUP_DIR} нет снимков")
+        restore_snapshot(path)
@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+"""Офлайн-бенчмарк парсеров на записанных ответах из fixtures/.
+
+Каждый парсер прогоняется через настоящий путь разбора и сохранения в БД
+(временная SQLite на каждую итерацию), сеть подменяется записанными ответами.
+
+    python benchmark.py                       # все парсеры, 20 итераций
+    python benchmark.py -n 50 kleinanzeigen   # только Kleinanzeigen
+    python benchmark.py --html-parser lxml    # сравнить парсер BeautifulSoup
+    python benchmark.py --json bench.json     # сохранить результаты
+"""
+import argparse
+import contextlib
+import copy
+import json
+import logging
+import os
+import tempfile
+import time
+import tracemalloc
+from unittest import mock
+
+import storage
+import geocode
+import Immoscout_bd
+import Immowelt
+import Kleinanzeigen
+import InBerlinwohnen
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+
+def load_fixture(name):
+    with open(os.path.join(FIXTURES_DIR, name), encoding="utf-8") as f:
+        return f.read()
+
+
+# === Подмена сети ===
+class ReplayResponse:
+    def __init__(self, text, status_code=200):
+        self.text = text
+        self.status_code = status_code
+
+    def json(self):
+        return json.loads(self.text)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise RuntimeError(f"HTTP {self.status_code}")
+
+
+class ReplaySession:
+    """Вместо http_client.get_session(): отдаёт записанный ответ по подстроке URL"""
+
+    def __init__(self, routes):
+        self.routes = routes
+
+    def _reply(self, url):
+        for fragment, body in self.routes.items():
+            if fragment in url:
+                return ReplayResponse(body)
+        return ReplayResponse("", status_code=404)
+
+    def get(self, url, *args, **kwargs):
+        return self._reply(url)
+
+    def post(self, url, *args, **kwargs):
+        return self._reply(url)
+
+
+# === Сценарии ===
+def open_db(db_path):
+    """Свежая временная база со схемой storage"""
+    storage.DB_FILE = db_path
+    storage._initialized = False
+    storage.seen_index = storage.SeenIndex()
+    conn = storage.connect()
+    cursor = conn.cursor()
+    storage.filter_unseen(cursor, "Immoscout", [])  # фильтр грузится раз на процесс — не в замер
+    return conn, cursor
+
+
+def bench_immoscout(db_path, batch=30):
+    """get_expose_details: пачка ID из поиска, каждый expose — записанный JSON"""
+    conn, cursor = open_db(db_path)
+    ids = [str(100000000 + i) for i in range(batch)]
+    routes = {"/expose/": load_fixture("immoscout_expose.json"),
+              "nominatim": load_fixture("nominatim_search.json")}
+
+    def run():
+        with mock.patch.object(Immoscout_bd, "get_session", lambda: ReplaySession(routes)), \
+                mock.patch.object(geocode, "get_session", lambda: ReplaySession(routes)):
+            Immoscout_bd.get_expose_details({}, ids)
+        return len(ids)
+
+    return run, conn
+
+
+def bench_immowelt(db_path):
+    """filter_unseen -> ImmoweltScraper.parse_listing для ответа classifiedList -> store_listings"""
+    conn, cursor = open_db(db_path)
+    details = json.loads(load_fixture("immowelt_classified_list.json"))
+    scraper = Immowelt.ImmoweltScraper()
+
+    def run():
+        unseen = set(storage.filter_unseen(cursor, "Immowelt", [listing["id"] for listing in details]))
+        parsed = [scraper.parse_listing(listing) for listing in copy.deepcopy(details) if listing["id"] in unseen]
+        storage.store_listings("Immowelt", [entry for entry in parsed if entry])
+        return len(details)
+
+    return run, conn
+
+
+def bench_kleinanzeigen(db_path):
+    """Страница поиска -> extract_data (с деталями, геокодом и store_listings по одному)"""
+    conn, cursor = open_db(db_path)
+    routes = {"/s-wohnung-mieten/": load_fixture("kleinanzeigen_search.html"),
+              "/s-anzeige/": load_fixture("kleinanzeigen_detail.html"),
+              "nominatim": load_fixture("nominatim_search.json")}
+
+    def run():
+        with mock.patch.object(Kleinanzeigen, "get_session", lambda: ReplaySession(routes)), \
+                mock.patch.object(geocode, "get_session", lambda: ReplaySession(routes)):
+            soup = Kleinanzeigen.fetch_html(Kleinanzeigen.BASE_URL)
+            entries = Kleinanzeigen.extract_data(soup, cursor)
+        return len(entries)
+
+    return run, conn
+
+
+def bench_inberlin(db_path):
+    """fetch_inberlin_listings на записанном ответе wohnungsfinder.php -> store_listings"""
+    conn, cursor = open_db(db_path)
+    routes = {"wohnungsfinder.php": load_fixture("inberlin_wohnungsfinder.json")}
+
+    def run():
+        with mock.patch.object(InBerlinwohnen, "get_session", lambda: ReplaySession(routes)):
+            listings = InBerlinwohnen.fetch_inberlin_listings(cursor)
+            storage.store_listings("InBerlinWohnen", listings)
+        return len(listings)
+
+    return run, conn
+
+
+BENCHMARKS = {
+    "immoscout": bench_immoscout,
+    "immowelt": bench_immowelt,
+    "kleinanzeigen": bench_kleinanzeigen,
+    "inberlin": bench_inberlin,
+}
+
+
+# === Замеры ===
+def measure(setup, iterations):
+    """Скорость без трассировки, память — отдельным прогоном под tracemalloc"""
+    total_listings = 0
+    elapsed = 0.0
+    peak = 0
+    alloc_blocks = 0
+    alloc_bytes = 0
+
+    with tempfile.TemporaryDirectory() as tmp, mock.patch("time.sleep"):
+        for i in range(iterations):
+            run, conn = setup(os.path.join(tmp, f"speed_{i}.db"))
+            start = time.perf_counter()
+            total_listings += run()
+            elapsed += time.perf_counter() - start
+            conn.close()
+
+        for i in range(iterations):
+            run, conn = setup(os.path.join(tmp, f"mem_{i}.db"))
+            tracemalloc.start()
+            before = tracemalloc.take_snapshot()
+            run()
+            after = tracemalloc.take_snapshot()
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+            diff = after.compare_to(before, "filename")
+            alloc_blocks += sum(stat.count_diff for stat in diff if stat.count_diff > 0)
+            alloc_bytes += sum(stat.size_diff for stat in diff if stat.size_diff > 0)
+            conn.close()
+
+    per_listing = total_listings / iterations or 1
+    return {
+        "iterations": iterations,
+        "listings": total_listings,
+        "listings_per_sec": round(total_listings / elapsed, 1) if elapsed else None,
+        "ms_per_listing": round(elapsed * 1000 / total_listings, 3) if total_listings else None,
+        "alloc_blocks_per_listing": round(alloc_blocks / iterations / per_listing, 1),
+        "alloc_kib_per_listing": round(alloc_bytes / iterations / per_listing / 1024, 2),
+        "peak_mem_kib": round(peak / 1024, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк парсеров")
+    parser.add_argument("names", nargs="*", help=f"какие парсеры гонять: {', '.join(BENCHMARKS)}")
+    parser.add_argument("-n", "--iterations", type=int, default=20)
+    parser.add_argument("--html-parser", help="парсер BeautifulSoup (html.parser, lxml, html5lib)")
+    parser.add_argument("--json", help="сохранить результаты в файл")
+    args = parser.parse_args()
+    unknown = set(args.names) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f"неизвестные парсеры: {', '.join(sorted(unknown))}")
+
+    if args.html_parser:
+        Kleinanzeigen.HTML_PARSER = args.html_parser
+        InBerlinwohnen.HTML_PARSER = args.html_parser
+
+    logging.disable(logging.WARNING)
+    results = {}
+    for name in args.names or BENCHMARKS:
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            results[name] = measure(BENCHMARKS[name], args.iterations)
+
+    header = f"{'parser':<14}{'listings/s':>12}{'ms/listing':>12}{'allocs/listing':>16}{'KiB/listing':>13}{'peak KiB':>10}"
+    print(header)
+    print("-" * len(header))
+    for name, r in results.items():
+        print(f"{name:<14}{r['listings_per_sec']:>12}{r['ms_per_listing']:>12}"
+              f"{r['alloc_blocks_per_listing']:>16}{r['alloc_kib_per_listing']:>13}{r['peak_mem_kib']:>10}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"html_parser": Kleinanzeigen.HTML_PARSER, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
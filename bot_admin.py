@@ -1,5 +1,4 @@
 # -*- coding: utf-8 -*-
-import sqlite3
 import pandas as pd
 import asyncio
 import os
@@ -10,6 +9,8 @@ from aiogram.filters import Command
 from aiogram.client.default import DefaultBotProperties
 from dotenv import load_dotenv
 
+from storage import connect, release, execute_write
+
 # === Загрузка .env ===
 load_dotenv()
 
@@ -28,11 +29,11 @@ def is_admin(user_id: int) -> bool:
 
 # 📊 Функция экспорта таблицы из SQLite в Excel
 def export_table_to_excel(table_name: str) -> str:
-    conn = sqlite3.connect("seen_ids.db")
+    conn = connect()
     df = pd.read_sql_query(f"SELECT * FROM {table_name}", conn)
     filepath = f"{table_name}.xlsx"
     df.to_excel(filepath, index=False)
-    conn.close()
+    release(conn)
     return filepath
 
 # 🔘 /start
@@ -74,11 +75,9 @@ async def set_subscription(message: Message):
         return
     try:
         _, user_id, date_str = message.text.strip().split()
-        conn = sqlite3.connect("seen_ids.db")
-        cursor = conn.cursor()
-        cursor.execute("UPDATE users SET subscribed_until = ? WHERE user_id = ?", (date_str, user_id))
-        conn.commit()
-        conn.close()
+        await asyncio.wrap_future(
+            execute_write("UPDATE users SET subscribed_until = ? WHERE user_id = ?", (date_str, user_id))
+        )
         await message.answer(f"✅ Подписка пользователю {user_id} установлена до {date_str}")
     except Exception as e:
         await message.answer(f"❌ Ошибка: {e}\nФормат: /set_sub <user_id> <YYYY-MM-DD>")
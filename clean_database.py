@@ -1,7 +1,4 @@
 # -*- coding: utf-8 -*-
-import sqlite3
-import requests
-from datetime import datetime
 from time import sleep
 from bs4 import BeautifulSoup
 import os
@@ -9,6 +6,10 @@ import time
 import logging
 from dotenv import load_dotenv
 
+from http_client import get_session
+from immoscout_auth import get_headers, token_manager
+from storage import connect, release, execute_write, CLEANER_BATCH_QUERIES, SOURCE_CODES
+
 # === Загрузка .env ===
 load_dotenv()
 
@@ -24,27 +25,16 @@ logging.basicConfig(
 )
 
 # === Константы ===
-DB_PATH = os.getenv("DB_FILE", "seen_ids.db")
 BATCH_SIZE = 100
 STATE_FILE_NULL = "last_checked_id_null.txt"
 STATE_FILE_ACTIVE = "last_checked_id_active.txt"
 MODE_STATE_FILE = "mode_state.txt"
 
-CLIENT_ID = os.getenv("IMMOSCOUT_CLIENT_ID", "ImmobilienScout24-iPhone-Wohnen-AppKey")
-CLIENT_SECRET = os.getenv("IMMOSCOUT_CLIENT_SECRET", "CHANGE_ME")
-
-
-def get_immoscout_token():
-    """Получает OAuth-токен для ImmoScout"""
-    token_url = "https://publicauth.immobilienscout24.de/oauth/token"
-    params = {
-        "client_id": CLIENT_ID,
-        "grant_type": "client_credentials",
-        "client_secret": CLIENT_SECRET
-    }
-    resp = requests.post(token_url, params=params, timeout=10)
-    resp.raise_for_status()
-    return resp.json().get("access_token")
+# Какие источники умеем проверять: код источника -> проверка
+CHECKERS = {
+    SOURCE_CODES["Immoscout"]: "immoscout",
+    SOURCE_CODES["Kleinanzeigen"]: "kleinanzeigen",
+}
 
 
 def immoscout_is_active(data):
@@ -55,7 +45,11 @@ def immoscout_is_active(data):
 def check_immoscout_listing(obj_id, headers):
     url = f"https://api.mobile.immobilienscout24.de/expose/{obj_id}?adType=RENT"
     try:
-        resp = requests.get(url, headers=headers, timeout=10)
+        resp = get_session().get(url, headers=headers, timeout=10)
+        if resp.status_code == 401:
+            # Токен не приняли — объявление тут ни при чём, удалять его нельзя
+            token_manager.invalidate()
+            return "unauthorized"
         if resp.status_code == 404:
             return "not_found"
         resp.raise_for_status()
@@ -69,7 +63,7 @@ def check_kleinanzeigen_listing(url):
     headers = {"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64)"}
     try:
         logging.info(f"[clean_db] Проверка Kleinanzeigen: {url}")
-        resp = requests.get(url, headers=headers, timeout=10)
+        resp = get_session().get(url, headers=headers, timeout=10)
         if resp.status_code == 404:
             return "deleted"
         soup = BeautifulSoup(resp.text, "html.parser")
@@ -100,147 +94,107 @@ def save_mode(mode):
 
 
 def get_last_checked_id(mode):
+    """Последний проверенный ключ (source, id); None — начать сначала"""
     path = STATE_FILE_NULL if mode == "null" else STATE_FILE_ACTIVE
     try:
         if os.path.exists(path):
             with open(path, "r") as f:
-                return f.read().strip()
+                source, sep, obj_id = f.read().strip().partition(":")
+            # Старый формат (только id) — просто проходим таблицу заново
+            if sep and source.isdigit():
+                return int(source), obj_id
     except Exception as e:
         logging.warning(f"⚠️ Не удалось прочитать {path}: {e}")
     return None
 
 
-def save_last_checked_id(last_id, mode):
+def save_last_checked_id(last_key, mode):
     path = STATE_FILE_NULL if mode == "null" else STATE_FILE_ACTIVE
     try:
         with open(path, "w") as f:
-            f.write(str(last_id))
+            f.write(f"{last_key[0]}:{last_key[1]}")
     except Exception as e:
         logging.warning(f"⚠️ Не удалось сохранить {path}: {e}")
 
 
-def create_tables():
-    conn = sqlite3.connect(DB_PATH)
+def get_next_batch(conn, last_key, is_null_mode):
     cursor = conn.cursor()
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS listings (
-            id TEXT PRIMARY KEY,
-            url TEXT,
-            price REAL,
-            size REAL,
-            address TEXT,
-            lat REAL,
-            lon REAL,
-            swapflat INTEGER,
-            wbs_required INTEGER,
-            created_at TEXT,
-            source_immoscout INTEGER DEFAULT 0,
-            source_kleinanzeigen INTEGER DEFAULT 0,
-            is_active INTEGER,
-            last_checked TEXT
-        )
-    """)
-    conn.commit()
-    conn.close()
-
-
-def get_next_batch(conn, last_id, is_null_mode):
-    cursor = conn.cursor()
-    condition = "is_active IS NULL" if is_null_mode else "is_active = 1"
-    if last_id:
-        cursor.execute(f"""
-            SELECT * FROM listings
-            WHERE {condition} AND id > ?
-            ORDER BY id
-            LIMIT ?
-        """, (last_id, BATCH_SIZE))
+    query = CLEANER_BATCH_QUERIES["null" if is_null_mode else "active"]
+    # Коды источников >= 0, id — строки: (0, "") меньше любого ключа
+    source, obj_id = last_key or (0, "")
+    cursor.execute(query, (source, obj_id, BATCH_SIZE))
+    batch = cursor.fetchall()
+    if not batch and last_key:
+        cursor.execute(query, (0, "", BATCH_SIZE))
         batch = cursor.fetchall()
-        if not batch:
-            cursor.execute(f"""
-                SELECT * FROM listings
-                WHERE {condition}
-                ORDER BY id
-                LIMIT ?
-            """, (BATCH_SIZE,))
-            return cursor.fetchall()
-        return batch
-    else:
-        cursor.execute(f"""
-            SELECT * FROM listings
-            WHERE {condition}
-            ORDER BY id
-            LIMIT ?
-        """, (BATCH_SIZE,))
-        return cursor.fetchall()
+    return batch
 
 
 def run():
     try:
         MAX_RUNTIME = 100
         start_time = time.time()
-        create_tables()
 
         mode = read_mode()
         is_null_mode = mode == "null"
         next_mode = "active" if is_null_mode else "null"
 
-        token = get_immoscout_token()
-        immoscout_headers = {
-            "Authorization": f"Bearer {token}",
-            "User-Agent": "ImmoScout_26.19.3_18.1.1_._",
-            "Accept": "application/json",
-            "x-is24-device": "iphone",
-            "x_is24_client_id": "65E7AE2B87FF46FBB44649D55E68687E"
-        }
+        immoscout_headers = get_headers()
 
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row
+        conn = connect()
 
-        last_id = get_last_checked_id(mode)
-        batch = get_next_batch(conn, last_id, is_null_mode)
+        last_key = get_last_checked_id(mode)
+        batch = get_next_batch(conn, last_key, is_null_mode)
 
         if not batch:
             logging.info("🟡 Нет записей — переключаем режим")
             save_mode(next_mode)
-            conn.close()
+            release(conn)
             return
 
-        for row in batch:
+        for source, obj_id, url in batch:
             if time.time() - start_time > MAX_RUNTIME:
                 logging.info("⏱️ Время вышло — завершаем итерацию")
                 break
 
-            checker_type = "kleinanzeigen" if row["source_kleinanzeigen"] else "immoscout" if row["source_immoscout"] else None
+            checker_type = CHECKERS.get(source)
             if not checker_type:
                 continue
 
             if checker_type == "immoscout":
-                obj_id = int(row["id"]) if row["id"].isdigit() else row["id"]
-                status = check_immoscout_listing(obj_id, immoscout_headers)
+                expose_id = int(obj_id) if obj_id.isdigit() else obj_id
+                status = check_immoscout_listing(expose_id, immoscout_headers)
+                if status == "unauthorized":
+                    immoscout_headers = get_headers()
+                    status = check_immoscout_listing(expose_id, immoscout_headers)
+                if status == "unauthorized":
+                    logging.warning("🔑 ImmoScout не принимает токен — прерываем проверку, объявления не трогаем")
+                    break
             elif checker_type == "kleinanzeigen":
-                status = check_kleinanzeigen_listing(row["url"])
+                status = check_kleinanzeigen_listing(url)
             else:
                 status = None
 
             is_active = 1 if status == "active" else 0
-            now = datetime.now().isoformat()
-            cursor = conn.cursor()
+            now = int(time.time())
 
+            # Результат не ждём: запись уходит в общую транзакцию потока записи
             if is_active == 0:
-                cursor.execute("DELETE FROM listings WHERE id = ?", (row["id"],))
+                execute_write("DELETE FROM listings WHERE source = ? AND id = ?", (source, obj_id))
             elif is_active == 1:
-                cursor.execute("""
+                # is_active — TEXT: пишем "1", как store_listings (PostgreSQL не сравнит TEXT с числом)
+                execute_write("""
                     UPDATE listings SET is_active = ?, last_checked = ?
-                    WHERE id = ?
-                """, (is_active, now, row["id"]))
+                    WHERE source = ? AND id = ?
+                """, ("1", now, source, obj_id))
 
-            conn.commit()
-            last_id = row["id"]
+            last_key = (source, obj_id)
             sleep(1)
 
-        save_last_checked_id(last_id, mode)
+        if last_key:
+            save_last_checked_id(last_key, mode)
         save_mode(next_mode)
-        conn.close()
+        release(conn)
 
     except Exception as e:
         logging.error(f"🔥 Ошибка в процессе очистки: {e}")
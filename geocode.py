@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+"""Геокодирование адресов через Nominatim (OpenStreetMap), общее для всех парсеров.
+
+Парсеры работают параллельно, а Nominatim разрешает не больше 1 запроса в
+секунду с одного клиента, поэтому лимитер один на процесс.
+"""
+from http_client import get_session
+from metrics import timer
+from rate_limit import TokenBucket
+
+NOMINATIM_URL = "https://nominatim.openstreetmap.org/search"
+NOMINATIM_HEADERS = {"User-Agent": "Mozilla/5.0 (compatible; WohnungsBot/1.0)"}
+NOMINATIM_LIMITER = TokenBucket(rate=1, capacity=1)
+
+
+def geocode_address(address, source):
+    """Координаты (lat, lon) по адресу или (None, None); source — для метрик"""
+    NOMINATIM_LIMITER.acquire()
+    with timer("geocode_address", source):
+        try:
+            params = {"q": address, "format": "json", "addressdetails": 1, "limit": 1}
+            response = get_session().get(NOMINATIM_URL, params=params, headers=NOMINATIM_HEADERS, timeout=10)
+            response.raise_for_status()
+            data = response.json()
+            if data:
+                return float(data[0]["lat"]), float(data[0]["lon"])
+        except Exception:
+            pass
+    return None, None
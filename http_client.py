@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from dotenv import load_dotenv
+
+# === Загрузка .env ===
+load_dotenv()
+
+# === Константы ===
+DEFAULT_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "15"))
+POOL_CONNECTIONS = int(os.getenv("HTTP_POOL_CONNECTIONS", "20"))  # сколько хостов держим в пуле
+POOL_MAXSIZE = int(os.getenv("HTTP_POOL_MAXSIZE", "10"))  # keep-alive соединений на хост
+HTTP2_ENABLED = os.getenv("HTTP2", "0") == "1"
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter с таймаутом по умолчанию для запросов, где он не указан"""
+
+    def __init__(self, *args, timeout=DEFAULT_TIMEOUT, **kwargs):
+        self.timeout = timeout
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
+        return super().send(request, **kwargs)
+
+
+def _create_http2_client(proxy, timeout):
+    """httpx-клиент с HTTP/2 (нужен пакет httpx[http2]); None, если он не установлен"""
+    try:
+        import httpx
+    except ImportError:
+        logging.warning("⚠️ HTTP2=1, но httpx не установлен — используем requests (HTTP/1.1)")
+        return None
+    limits = httpx.Limits(max_connections=POOL_CONNECTIONS * POOL_MAXSIZE,
+                          max_keepalive_connections=POOL_CONNECTIONS * POOL_MAXSIZE)
+    # requests следует редиректам сам, httpx — только с follow_redirects
+    return httpx.Client(http2=True, timeout=timeout, limits=limits, proxy=proxy or None,
+                        follow_redirects=True)
+
+
+def create_session(proxy=None, timeout=DEFAULT_TIMEOUT):
+    """Новая сессия с пулом соединений по хостам, keep-alive и таймаутом по умолчанию.
+
+    Интерфейс get/post/json/status_code одинаков у requests.Session и httpx.Client,
+    поэтому парсерам всё равно, какой из них вернулся.
+    """
+    if HTTP2_ENABLED:
+        client = _create_http2_client(proxy, timeout)
+        if client is not None:
+            return client
+
+    session = requests.Session()
+    adapter = TimeoutHTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE,
+                                 timeout=timeout)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    if proxy:
+        session.proxies = {"http": proxy, "https": proxy}
+    return session
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """Общая на процесс сессия для всех парсеров"""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = create_session()
+    return _session
+
+
+_named_sessions = {}
+
+
+def get_named_session(name, proxy=None):
+    """Общая на процесс отдельная сессия name — для источников со своим прокси и cookie.
+
+    Одна на весь процесс, а не на каждый запуск парсера: keep-alive переживает
+    циклы опроса, и пулы соединений не копятся.
+    """
+    session = _named_sessions.get(name)
+    if session is None:
+        with _session_lock:
+            session = _named_sessions.get(name)
+            if session is None:
+                session = _named_sessions[name] = create_session(proxy=proxy)
+    return session
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+import threading
+import time
+from dotenv import load_dotenv
+
+from http_client import get_session
+
+# === Загрузка .env ===
+load_dotenv()
+
+# === Константы ===
+TOKEN_URL = "https://publicauth.immobilienscout24.de/oauth/token"
+CLIENT_ID = os.getenv("IMMOSCOUT_CLIENT_ID", "ImmobilienScout24-iPhone-Wohnen-AppKey")
+CLIENT_SECRET = os.getenv("IMMOSCOUT_CLIENT_SECRET", "CHANGE_ME")
+REFRESH_MARGIN = int(os.getenv("IMMOSCOUT_TOKEN_REFRESH_MARGIN", "120"))  # сек до истечения
+DEFAULT_TTL = 3600  # если сервер не прислал expires_in
+RETRY_DELAY = 30
+
+
+class TokenManager:
+    """OAuth-токен ImmoScout, общий для всех потоков процесса.
+
+    Токен кэшируется до REFRESH_MARGIN сек перед истечением; фоновый поток
+    обновляет его заранее, так что get_token() обычно отдаёт его без сети.
+    """
+
+    def __init__(self, client_id, client_secret, margin=REFRESH_MARGIN):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.margin = margin
+        self._lock = threading.Lock()
+        self._token = None
+        self._expires_at = 0.0
+        self._refresher = None
+
+    def _valid(self):
+        return self._token is not None and time.monotonic() < self._expires_at - self.margin
+
+    def _fetch(self):
+        params = {
+            "client_id": self.client_id,
+            "grant_type": "client_credentials",
+            "client_secret": self.client_secret
+        }
+        resp = get_session().post(TOKEN_URL, params=params, timeout=10)
+        resp.raise_for_status()
+        data = resp.json()
+        self._token = data["access_token"]
+        self._expires_at = time.monotonic() + float(data.get("expires_in") or DEFAULT_TTL)
+        logging.info(f"🔑 Токен ImmoScout обновлён, действует {int(self._expires_at - time.monotonic())} сек")
+
+    def get_token(self):
+        if not self._valid():
+            with self._lock:
+                if not self._valid():
+                    self._fetch()
+        self._start_refresher()
+        return self._token
+
+    def invalidate(self):
+        """Сбросить токен (например, после 401) — следующий get_token() получит новый"""
+        with self._lock:
+            self._token = None
+            self._expires_at = 0.0
+
+    def _start_refresher(self):
+        if self._refresher is None:
+            with self._lock:
+                if self._refresher is None:
+                    self._refresher = threading.Thread(target=self._refresh_loop, daemon=True,
+                                                       name="immoscout-token")
+                    self._refresher.start()
+
+    def _refresh_loop(self):
+        while True:
+            # Просыпаемся чуть раньше, чем get_token() счёл бы токен устаревшим
+            delay = self._expires_at - self.margin * 1.5 - time.monotonic()
+            time.sleep(max(delay, 1.0))
+            if self._token is not None and time.monotonic() < self._expires_at - self.margin * 1.5:
+                continue
+            try:
+                with self._lock:
+                    self._fetch()
+            except Exception as e:
+                logging.warning(f"⚠️ Не удалось обновить токен ImmoScout: {e}")
+                time.sleep(RETRY_DELAY)
+
+
+token_manager = TokenManager(CLIENT_ID, CLIENT_SECRET)
+
+
+def get_headers():
+    """Заголовки мобильного API ImmoScout с актуальным токеном"""
+    return {
+        "Authorization": f"Bearer {token_manager.get_token()}",
+        "User-Agent": "ImmoScout_26.19.3_18.1.1_._",
+        "Accept": "application/json",
+        "x-is24-device": "iphone",
+        "x_is24_client_id": "65E7AE2B87FF46FBB44649D55E68687E"
+    }
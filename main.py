@@ -3,22 +3,53 @@ import subprocess
 import sys
 import threading
 import time
-import requests
 import os
 from dotenv import load_dotenv
 
 from Immoscout_bd import run as run_immoscout
 from Immowelt import run as run_immowelt
-from telegram_sender import run as run_sender
+from telegram_sender import run as run_sender, send_listings, mark_delivered_until, expire_sent_records
 from Kleinanzeigen import run as run_kleinanzeigen
 from clean_database import run as run_cleanup
 from InBerlinwohnen import run as run_inberlinwohnen
+from orchestrator import Orchestrator, Source
+from pipeline import start_delivery
+from metrics import start_metrics_server, start_snapshot_writer
+from scheduler import Scheduler, AdaptiveInterval
+from http_client import get_session
+from storage import init_db, get_backend, STORAGE_BACKEND
+from backup import create_snapshot, BACKUP_INTERVAL
 
 # === Загрузка .env ===
 load_dotenv()
 
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 ADMIN_ID = int(os.getenv("ADMIN_ID", "0"))
+# Узел только с парсерами: с общей базой (STORAGE_BACKEND=postgres) бота, очистку и
+# рассылку держит ровно один узел, на остальных — SCRAPER_ONLY=1
+SCRAPER_ONLY = os.getenv("SCRAPER_ONLY", "0") == "1"
+# С общей базой: как часто рассылка забирает из базы объявления парсеров других узлов (сек)
+DELIVERY_POLL_INTERVAL = int(os.getenv("DELIVERY_POLL_INTERVAL", "30"))
+
+# Лимиты времени на один запуск каждого источника (сек)
+SOURCE_TIMEOUTS = {
+    "Immoscout": int(os.getenv("TIMEOUT_IMMOSCOUT", "90")),
+    "Immowelt": int(os.getenv("TIMEOUT_IMMOWELT", "60")),
+    "Kleinanzeigen": int(os.getenv("TIMEOUT_KLEINANZEIGEN", "120")),
+    "InBerlinWohnen": int(os.getenv("TIMEOUT_INBERLINWOHNEN", "120")),
+}
+
+# Границы интервала опроса каждого источника (сек): (min, max)
+SOURCE_INTERVALS = {
+    "Immoscout": (int(os.getenv("INTERVAL_MIN_IMMOSCOUT", "20")),
+                  int(os.getenv("INTERVAL_MAX_IMMOSCOUT", "180"))),
+    "Immowelt": (int(os.getenv("INTERVAL_MIN_IMMOWELT", "45")),
+                 int(os.getenv("INTERVAL_MAX_IMMOWELT", "300"))),
+    "Kleinanzeigen": (int(os.getenv("INTERVAL_MIN_KLEINANZEIGEN", "45")),
+                      int(os.getenv("INTERVAL_MAX_KLEINANZEIGEN", "300"))),
+    "InBerlinWohnen": (int(os.getenv("INTERVAL_MIN_INBERLINWOHNEN", "120")),
+                       int(os.getenv("INTERVAL_MAX_INBERLINWOHNEN", "900"))),
+}
 
 
 def send_error_message(context, error):
@@ -31,7 +62,7 @@ def send_error_message(context, error):
             f"🔴 Тип: <code>{error_type}</code>\n"
             f"💬 Описание: <code>{error_msg}</code>"
         )
-        requests.post(
+        get_session().post(
             f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage",
             json={"chat_id": ADMIN_ID, "text": text, "parse_mode": "HTML"}
         )
@@ -50,63 +81,75 @@ def run_cleanup_periodically():
         try:
             print("🧹 Плановая очистка базы данных...")
             run_cleanup()
+            expire_sent_records()
         except Exception as e:
             send_error_message("Плановая очистка БД", e)
         time.sleep(300)
 
 
-if __name__ == "__main__":
-    # запускаем фоново бота и очистку
-    threading.Thread(target=run_telegram_bot, daemon=True).start()
-    threading.Thread(target=run_cleanup_periodically, daemon=True).start()
-    print("🤖 Telegram-бот и плановая очистка запущены")
-
+def run_backup_periodically():
+    """Сжатый снимок базы каждые BACKUP_INTERVAL сек, без остановки записи"""
     while True:
-        print("🔍 Проверка новых объявлений...")
+        time.sleep(BACKUP_INTERVAL)
+        try:
+            create_snapshot()
+        except Exception as e:
+            send_error_message("Снимок БД", e)
 
-        start_time = time.time()
-        found_new = False
 
-        try:
-            try:
-                if run_immoscout():
-                    found_new = True
-            except Exception as e:
-                send_error_message("Immoscout", e)
-
-            try:
-                if run_immowelt():
-                    found_new = True
-            except Exception as e:
-                send_error_message("Immowelt", e)
-
-            try:
-                if run_kleinanzeigen():
-                    found_new = True
-            except Exception as e:
-                send_error_message("Kleinanzeigen", e)
-
-            try:
-                if run_inberlinwohnen():
-                    found_new = True
-            except Exception as e:
-                send_error_message("InBerlinWohnen", e)
-
-            if found_new:
-                print("📬 Новые объявления найдены! Отправляем пользователям...")
-                try:
-                    run_sender()
-                except Exception as e:
-                    send_error_message("Рассылка Telegram", e)
-            else:
-                print("⏳ Новых объявлений нет.")
+if __name__ == "__main__":
+    # Схема и миграции — один раз до запуска потоков
+    init_db()
 
+    # запускаем фоново бота и очистку
+    if not SCRAPER_ONLY:
+        threading.Thread(target=run_telegram_bot, daemon=True).start()
+        threading.Thread(target=run_cleanup_periodically, daemon=True).start()
+        if STORAGE_BACKEND == "sqlite" and BACKUP_INTERVAL > 0:
+            threading.Thread(target=run_backup_periodically, daemon=True).start()
+        print("🤖 Telegram-бот, плановая очистка и снимки базы запущены")
+
+    # Тайминги этапов: локальный HTTP-эндпоинт и периодический снимок в файл
+    start_metrics_server()
+    start_snapshot_writer()
+
+    # Рассылка работает в своём потоке: каждое сохранённое объявление сразу уходит
+    # в неё через ограниченную очередь. При старте досылаем пропущенное за простой.
+    # С общей базой объявления других узлов в очередь не попадают — их забирает
+    # периодический опрос окна last_run, и сдвигает окно только он: сдвиг по
+    # опустевшей очереди пропустил бы то, что сохранили другие узлы
+    if SCRAPER_ONLY:
+        print("📦 SCRAPER_ONLY: только парсеры, рассылку ведёт другой узел")
+    elif get_backend().shared:
+        start_delivery(send_listings, catch_up=run_sender, poll_interval=DELIVERY_POLL_INTERVAL,
+                       on_error=send_error_message)
+    else:
+        start_delivery(send_listings, catch_up=run_sender, on_idle=mark_delivered_until,
+                       on_error=send_error_message)
+
+    def on_new(name):
+        print(f"📬 {name}: новые объявления переданы в рассылку")
+
+    orchestrator = Orchestrator(
+        [
+            Source("Immoscout", run_immoscout, SOURCE_TIMEOUTS["Immoscout"]),
+            Source("Immowelt", run_immowelt, SOURCE_TIMEOUTS["Immowelt"]),
+            Source("Kleinanzeigen", run_kleinanzeigen, SOURCE_TIMEOUTS["Kleinanzeigen"]),
+            Source("InBerlinWohnen", run_inberlinwohnen, SOURCE_TIMEOUTS["InBerlinWohnen"]),
+        ],
+        on_new=on_new,
+        on_error=send_error_message
+    )
+
+    scheduler = Scheduler(
+        orchestrator,
+        {name: AdaptiveInterval(*bounds) for name, bounds in SOURCE_INTERVALS.items()}
+    )
+
+    print("🔍 Запускаем опрос источников...")
+    while True:
+        try:
+            scheduler.tick()
         except Exception as e:
             send_error_message("Main loop", e)
-
-        duration = time.time() - start_time
-        if duration > 180:
-            send_error_message("Main loop (длительность)", TimeoutError(f"Цикл длился слишком долго: {round(duration)} сек"))
-
-        print("🔁 Ожидание 60 секунд...\n")
-        time.sleep(60)
+            time.sleep(5)
@@ -0,0 +1,383 @@
+# -*- coding: utf-8 -*-
+"""Сопоставление объявлений с фильтрами пользователей.
+
+UserIndex раскладывает фильтры по корзинам цены и площади, по источникам и
+по ячейкам сетки координат: для объявления перебираются только пользователи,
+чьи диапазоны и область поиска могут его принять, а точная проверка (границы,
+WBS, Tausch, геометрия) идёт уже по ним.
+
+MATCH_ENGINE=numpy (по умолчанию) вместо него сравнивает всех пользователей со
+всей пачкой объявлений массивами NumPy — см. matching_numpy.
+
+CompiledUsers держит фильтры разобранными между запусками рассылки и
+пересобирает их, только когда меняется таблица users.
+"""
+import math
+import os
+import threading
+import time
+from datetime import datetime
+from zoneinfo import ZoneInfo
+from dotenv import load_dotenv
+
+from storage import SOURCE_CODES, SEARCHING_USERS_QUERY, get_table_version
+
+load_dotenv()
+
+MATCH_ENGINE = os.getenv("MATCH_ENGINE", "numpy")  # numpy или index
+PRICE_BUCKET = float(os.getenv("MATCH_PRICE_BUCKET", "100"))  # €
+PRICE_BUCKETS = int(os.getenv("MATCH_PRICE_BUCKETS", "100"))  # выше PRICE_BUCKET * N — одна корзина
+SIZE_BUCKET = float(os.getenv("MATCH_SIZE_BUCKET", "10"))  # м²
+SIZE_BUCKETS = int(os.getenv("MATCH_SIZE_BUCKETS", "50"))
+GRID_CELL = float(os.getenv("MATCH_GRID_CELL", "0.1"))  # градусов, ~11 × 7 км в Германии
+GRID_MAX_CELLS = int(os.getenv("MATCH_GRID_MAX_CELLS", "200"))  # область больше — в общий список
+# Допуск упрощения полигона при сохранении, метров (0 — не упрощать)
+POLYGON_TOLERANCE = float(os.getenv("POLYGON_TOLERANCE", "25"))
+EARTH_RADIUS = 6371000
+BERLIN_TZ = ZoneInfo("Europe/Berlin")
+
+IMMOSCOUT = SOURCE_CODES["Immoscout"]
+KLEINANZEIGEN = SOURCE_CODES["Kleinanzeigen"]
+IMMOWELT = SOURCE_CODES["Immowelt"]
+INBERLINWOHNEN = SOURCE_CODES["InBerlinWohnen"]
+# Источник, который пользователь не выключал, ничем не отфильтрован (например WgGesucht)
+ALL_SOURCES = sum(1 << code for code in SOURCE_CODES.values()) | 1
+
+
+# === Геометрия ===
+def calculate_distance(lat1, lon1, lat2, lon2):
+    """Вычисление расстояния между координатами (метры)."""
+    R = EARTH_RADIUS
+    lat1_rad, lon1_rad = math.radians(lat1), math.radians(lon1)
+    lat2_rad, lon2_rad = math.radians(lat2), math.radians(lon2)
+    dlat = lat2_rad - lat1_rad
+    dlon = lon2_rad - lon1_rad
+    a = math.sin(dlat / 2) ** 2 + math.cos(lat1_rad) * math.cos(lat2_rad) * math.sin(dlon / 2) ** 2
+    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+    return R * c
+
+
+def polygon_edges(polygon):
+    """Рёбра полигона для point_in_polygon: (lon_i, lon_j, lat_i, slope), наклон посчитан заранее"""
+    edges = []
+    j = len(polygon) - 1
+    for i in range(len(polygon)):
+        lat_i, lon_i = polygon[i]
+        lat_j, lon_j = polygon[j]
+        edges.append((lon_i, lon_j, lat_i, (lat_j - lat_i) / (lon_j - lon_i + 1e-15)))
+        j = i
+    return edges
+
+
+def point_in_polygon(lat, lon, edges):
+    """Проверка, входит ли точка в полигон (рёбра из polygon_edges)."""
+    inside = False
+    for lon_i, lon_j, lat_i, slope in edges:
+        if (lon_i > lon) != (lon_j > lon) and lat < slope * (lon - lon_i) + lat_i:
+            inside = not inside
+    return inside
+
+
+def simplify_polygon(polygon, tolerance=POLYGON_TOLERANCE):
+    """Douglas–Peucker для замкнутого контура: убирает вершины, которые отходят
+    от упрощённой границы меньше чем на tolerance метров. Остаётся не меньше 3 вершин."""
+    n = len(polygon)
+    if tolerance <= 0 or n <= 4:
+        return list(polygon)
+    # Локальная равнопромежуточная проекция в метры — на масштабе района точнее не нужно
+    lat0 = math.radians(sum(lat for lat, _ in polygon) / n)
+    scale = math.pi * EARTH_RADIUS / 180
+    xy = [(lon * scale * math.cos(lat0), lat * scale) for lat, lon in polygon]
+
+    def distance(p, a, b):
+        (px, py), (ax, ay), (bx, by) = p, a, b
+        dx, dy = bx - ax, by - ay
+        length2 = dx * dx + dy * dy
+        t = 0.0 if length2 == 0 else max(0.0, min(1.0, ((px - ax) * dx + (py - ay) * dy) / length2))
+        return math.hypot(px - ax - t * dx, py - ay - t * dy)
+
+    # Контур режется на две цепочки: от вершины 0 до самой дальней от неё и обратно
+    far = max(range(n), key=lambda i: math.hypot(xy[i][0] - xy[0][0], xy[i][1] - xy[0][1]))
+    keep = [False] * n
+    keep[0] = keep[far] = True
+    stack = [(0, far), (far, n)]
+    while stack:
+        first, last = stack.pop()
+        worst, worst_distance = None, tolerance
+        for i in range(first + 1, last):
+            d = distance(xy[i], xy[first], xy[last % n])
+            if d > worst_distance:
+                worst, worst_distance = i, d
+        if worst is not None:
+            keep[worst] = True
+            stack += [(first, worst), (worst, last)]
+
+    simplified = [point for point, kept in zip(polygon, keep) if kept]
+    return simplified if len(simplified) >= 3 else list(polygon)
+
+
+def parse_location(location_str):
+    """Парсинг строки локации (circle / polygon)."""
+    if not location_str:
+        return None, None
+    if ";" in location_str:
+        points = [p.strip() for p in location_str.split(";") if p.strip()]
+        polygon = [(float(p.split(",")[0]), float(p.split(",")[1])) for p in points]
+        return ("polygon", polygon) if len(polygon) >= 3 else (None, None)
+    else:
+        parts = location_str.split(",")
+        if len(parts) == 3:
+            lat, lon, radius = map(lambda x: float(x.strip()), parts)
+            return "circle", (lat, lon, radius)
+        return None, None
+
+
+def bounding_box(loc_type, loc_data):
+    """(min_lat, min_lon, max_lat, max_lon) области поиска"""
+    if loc_type == "circle":
+        lat, lon, radius = loc_data
+        angle = radius / EARTH_RADIUS
+        dlat = math.degrees(angle)
+        # Крайняя долгота окружности на сфере: sin(dlon) = sin(r/R) / cos(lat)
+        ratio = math.sin(min(angle, math.pi / 2)) / max(math.cos(math.radians(lat)), 1e-12)
+        dlon = 180.0 if ratio >= 1 else math.degrees(math.asin(ratio))
+        return lat - dlat, lon - dlon, lat + dlat, lon + dlon
+    lats = [p[0] for p in loc_data]
+    lons = [p[1] for p in loc_data]
+    return min(lats), min(lons), max(lats), max(lons)
+
+
+# === Фильтр пользователя ===
+class UserFilter:
+    """Фильтр одного ищущего пользователя в том виде, в каком его удобно проверять"""
+
+    __slots__ = ("user_id", "expires_at", "min_price", "max_price", "min_size", "max_size",
+                 "tauschwohnung", "wbs", "allowed_sources", "loc_type", "loc_data", "bbox", "circle", "edges")
+
+    def __init__(self, user_id, location, min_price, max_price, min_size, max_size,
+                 tauschwohnung, wbs, use_immoscout, use_kleinanzeigen, use_immowelt, use_inberlinwohnen,
+                 subscribed_until=None):
+        self.user_id = user_id
+        # subscribed_until хранится без зоны, по берлинскому времени
+        self.expires_at = (datetime.fromisoformat(subscribed_until).replace(tzinfo=BERLIN_TZ).timestamp()
+                           if subscribed_until else None)
+        # 0 и NULL — граница не задана
+        self.min_price = min_price or None
+        self.max_price = max_price or None
+        self.min_size = min_size or None
+        self.max_size = max_size or None
+        self.tauschwohnung = tauschwohnung
+        self.wbs = wbs
+
+        # Битовая маска разрешённых источников: проверка на объявление — одно &
+        self.allowed_sources = ALL_SOURCES
+        for code, enabled in ((IMMOSCOUT, use_immoscout), (KLEINANZEIGEN, use_kleinanzeigen),
+                              (IMMOWELT, use_immowelt), (INBERLINWOHNEN, use_inberlinwohnen)):
+            if not enabled:
+                self.allowed_sources &= ~(1 << code)
+
+        self.loc_type, self.loc_data = parse_location(location)
+        self.bbox = bounding_box(self.loc_type, self.loc_data) if self.loc_type else None
+        self.circle = None
+        self.edges = polygon_edges(self.loc_data) if self.loc_type == "polygon" else None
+        if self.loc_type == "circle":
+            # Гаверсинус с заранее посчитанными радианами центра: сравниваем hav(d/R)
+            # с hav(radius/R) и обходимся без atan2/sqrt на каждое объявление
+            lat_u, lon_u, radius_u = self.loc_data
+            half_angle = min(radius_u / (2 * EARTH_RADIUS), math.pi / 2)
+            self.circle = (math.radians(lat_u), math.radians(lon_u), math.cos(math.radians(lat_u)),
+                           math.sin(half_angle) ** 2)
+
+    @classmethod
+    def from_row(cls, row):
+        """Из строки SEARCHING_USERS_QUERY"""
+        (user_id, location, min_price, max_price, min_size, max_size,
+         subscribed_until, is_searching,
+         tauschwohnung, wbs,
+         use_immoscout, use_kleinanzeigen, use_immowelt, use_inberlinwohnen) = row
+        return cls(user_id, location, min_price, max_price, min_size, max_size,
+                   tauschwohnung, wbs, use_immoscout, use_kleinanzeigen, use_immowelt, use_inberlinwohnen,
+                   subscribed_until)
+
+    def accepts(self, listing):
+        """Проходит ли объявление (кортеж LISTING_COLUMNS) все условия фильтра"""
+        (source, listing_id, url, price, price_warm, size, address, lat_l, lon_l,
+         created_at, swapflat, wbs_required, photo_url) = listing
+
+        if not self.allowed_sources & (1 << source):
+            return False
+        if self.tauschwohnung == 0 and swapflat == 1:
+            return False
+        if self.wbs == 0 and wbs_required == 1:
+            return False
+        if self.min_price and price < self.min_price:
+            return False
+        if self.max_price and price > self.max_price:
+            return False
+        if self.min_size and size < self.min_size:
+            return False
+        if self.max_size and size > self.max_size:
+            return False
+        if self.bbox is None:
+            return False
+        min_lat, min_lon, max_lat, max_lon = self.bbox
+        if not (min_lat <= lat_l <= max_lat and min_lon <= lon_l <= max_lon):
+            return False
+        if self.circle is not None:
+            lat_u, lon_u, cos_lat_u, max_hav = self.circle
+            lat_rad = math.radians(lat_l)
+            hav = (math.sin((lat_rad - lat_u) / 2) ** 2
+                   + cos_lat_u * math.cos(lat_rad) * math.sin((math.radians(lon_l) - lon_u) / 2) ** 2)
+            return hav <= max_hav
+        if self.edges is not None:
+            return point_in_polygon(lat_l, lon_l, self.edges)
+        return False
+
+
+# === Индекс ===
+def _bucket(value, step, last):
+    return min(max(int(value // step), 0), last)
+
+
+def _cell(lat, lon, step):
+    return math.floor(lat / step), math.floor(lon / step)
+
+
+class UserIndex:
+    """Корзины по цене и площади, множества по источникам и сетка по координатам.
+
+    Пользователь с диапазоном цены [min, max] лежит во всех корзинах, которые
+    диапазон задевает (без границы — до крайней). В сетке он лежит во всех
+    ячейках, которые задевает прямоугольник его области; область больше
+    GRID_MAX_CELLS ячеек — в общем списке wide. Кандидаты для объявления —
+    пересечение его корзины цены, корзины площади, множества источника и
+    ячейки: работа растёт с числом подходящих пользователей, а не со всеми ищущими.
+    """
+
+    def __init__(self, filters, price_step=PRICE_BUCKET, price_buckets=PRICE_BUCKETS,
+                 size_step=SIZE_BUCKET, size_buckets=SIZE_BUCKETS,
+                 grid_cell=GRID_CELL, grid_max_cells=GRID_MAX_CELLS):
+        self.filters = [f for f in filters if f.loc_type is not None]
+        self.price_step = price_step
+        self.size_step = size_step
+        self.grid_cell = grid_cell
+        self.by_price = [set() for _ in range(price_buckets + 1)]
+        self.by_size = [set() for _ in range(size_buckets + 1)]
+        self.by_source = {}
+        self.grid = {}
+        self.wide = set()
+
+        for i, f in enumerate(self.filters):
+            self._spread(self.by_price, i, f.min_price, f.max_price, price_step)
+            self._spread(self.by_size, i, f.min_size, f.max_size, size_step)
+            for code in range(ALL_SOURCES.bit_length()):
+                if f.allowed_sources & (1 << code):
+                    self.by_source.setdefault(code, set()).add(i)
+
+            min_lat, min_lon, max_lat, max_lon = f.bbox
+            lat_from, lon_from = _cell(min_lat, min_lon, grid_cell)
+            lat_to, lon_to = _cell(max_lat, max_lon, grid_cell)
+            if (lat_to - lat_from + 1) * (lon_to - lon_from + 1) > grid_max_cells:
+                self.wide.add(i)
+                continue
+            for lat_key in range(lat_from, lat_to + 1):
+                for lon_key in range(lon_from, lon_to + 1):
+                    self.grid.setdefault((lat_key, lon_key), set()).add(i)
+
+    @staticmethod
+    def _spread(buckets, i, low, high, step):
+        last = len(buckets) - 1
+        first = _bucket(low, step, last) if low else 0
+        end = _bucket(high, step, last) if high else last
+        for b in range(first, end + 1):
+            buckets[b].add(i)
+
+    def candidates(self, source, price, size, lat, lon):
+        """Фильтры, которые могут принять объявление с такими источником, ценой, площадью и точкой"""
+        by_source = self.by_source.get(source)
+        if not by_source:
+            return []
+        by_price = self.by_price[_bucket(price, self.price_step, len(self.by_price) - 1)]
+        by_size = self.by_size[_bucket(size, self.size_step, len(self.by_size) - 1)]
+        cell = self.grid.get(_cell(lat, lon, self.grid_cell), set())
+
+        sets = sorted((by_source, by_price, by_size, cell), key=len)
+        hits = sets[0].intersection(*sets[1:])
+        if self.wide:
+            sets = sorted((by_source, by_price, by_size), key=len)
+            hits |= self.wide.intersection(*sets)
+        return [self.filters[i] for i in sorted(hits)]
+
+    def match(self, listings):
+        """Пары (фильтр, объявление) — по объявлениям, внутри — в порядке фильтров"""
+        pairs = []
+        for listing in listings:
+            try:
+                source, price, size = listing[0], listing[3], listing[5]
+                lat_l, lon_l, created_at = listing[7], listing[8], listing[9]
+                if None in (price, size, lat_l, lon_l, created_at):
+                    continue
+                for user_filter in self.candidates(source, price, size, lat_l, lon_l):
+                    if user_filter.accepts(listing):
+                        pairs.append((user_filter, listing))
+            except Exception as e:
+                print(f"[ERROR] Внутри цикла listings: {e}")
+        return pairs
+
+
+def build_matcher(filters):
+    """Сопоставитель из MATCH_ENGINE: numpy — матрицей, index — корзинами и сеткой"""
+    if MATCH_ENGINE == "numpy":
+        from matching_numpy import UserMatrix
+        return UserMatrix(filters)
+    if MATCH_ENGINE == "index":
+        return UserIndex(filters)
+    raise ValueError(f"Неизвестный MATCH_ENGINE: {MATCH_ENGINE}")
+
+
+# === Кэш фильтров ===
+class CompiledUsers:
+    """Разобранные фильтры ищущих пользователей и их сопоставитель между запусками рассылки.
+
+    Пересборка — только когда вырос счётчик изменений users (его ведут
+    триггеры в базе) или у кого-то истекла подписка; иначе get() — один
+    запрос к table_versions и сравнение со временем ближайшего истечения.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.version = None
+        self.filters = []
+        self.index = None
+        self.next_expiry = math.inf
+
+    def _build(self, filters):
+        self.filters = filters
+        self.index = build_matcher(filters)
+        self.next_expiry = min((f.expires_at for f in filters if f.expires_at is not None), default=math.inf)
+
+    def _load(self, cursor):
+        filters = []
+        cursor.execute(SEARCHING_USERS_QUERY)
+        for row in cursor.fetchall():
+            try:
+                filters.append(UserFilter.from_row(row))
+            except Exception as e:
+                print(f"[USER ERROR] User {row[0]}: {e}")
+        return filters
+
+    def get(self, cursor, now=None):
+        """(сопоставитель из build_matcher, ID пользователей, у которых подписка только что истекла)"""
+        now = time.time() if now is None else now
+        # Версию читаем до пользователей: изменение между запросами даст лишнюю пересборку, а не пропуск
+        version = get_table_version(cursor, "users")
+        with self._lock:
+            if self.index is None or version != self.version:
+                self._build(self._load(cursor))
+                self.version = version
+
+            expired = []
+            if now >= self.next_expiry:
+                expired = [f.user_id for f in self.filters if f.expires_at is not None and f.expires_at < now]
+                self._build([f for f in self.filters if f.expires_at is None or f.expires_at >= now])
+            return self.index, expired
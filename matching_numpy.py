@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""Векторное сопоставление (MATCH_ENGINE=numpy): все пользователи × вся пачка объявлений.
+
+Параметры фильтров лежат в массивах по пользователям, объявления пачки — в
+массивах по объявлениям. Источники, флаги WBS/Tausch, диапазоны цены и площади
+и прямоугольники областей сравниваются разом и дают матрицу кандидатов
+(пользователи × объявления); точная геометрия — гаверсинус для кругов и
+трассировка луча для полигонов — считается уже только по её парам.
+"""
+try:
+    import numpy as np
+except ImportError as e:
+    raise ImportError("MATCH_ENGINE=numpy требует пакет numpy: pip install numpy") from e
+
+
+def _bound(values, missing):
+    # None (граница не задана) -> ±inf: сравнение с ней всегда проходит
+    return np.array([missing if v is None else v for v in values], dtype=np.float64)
+
+
+class UserMatrix:
+    """Фильтры пользователей в виде массивов; match() — совпадения для пачки объявлений"""
+
+    def __init__(self, filters):
+        self.filters = [f for f in filters if f.loc_type is not None]
+        filters = self.filters
+
+        self.min_price = _bound((f.min_price for f in filters), -np.inf)
+        self.max_price = _bound((f.max_price for f in filters), np.inf)
+        self.min_size = _bound((f.min_size for f in filters), -np.inf)
+        self.max_size = _bound((f.max_size for f in filters), np.inf)
+        self.sources = np.array([f.allowed_sources for f in filters], dtype=np.int64)
+        self.no_swap = np.array([f.tauschwohnung == 0 for f in filters], dtype=bool)
+        self.no_wbs = np.array([f.wbs == 0 for f in filters], dtype=bool)
+        bbox = np.array([f.bbox for f in filters], dtype=np.float64).reshape(-1, 4)
+        self.min_lat, self.min_lon, self.max_lat, self.max_lon = bbox.T
+
+        # Круги: радианы центра, cos широты и hav(radius/R) — как в UserFilter.circle
+        self.is_circle = np.array([f.circle is not None for f in filters], dtype=bool)
+        circles = np.array([f.circle or (0.0, 0.0, 0.0, 0.0) for f in filters], dtype=np.float64).reshape(-1, 4)
+        self.circle_lat, self.circle_lon, self.circle_cos, self.circle_hav = circles.T
+
+        # Полигоны: рёбра из UserFilter.edges (с готовым наклоном) всех полигонов подряд;
+        # у пользователя — отрезок [start, start + count)
+        self.edge_start = np.zeros(len(filters), dtype=np.int64)
+        self.edge_count = np.zeros(len(filters), dtype=np.int64)
+        edges = []
+        total = 0
+        for i, f in enumerate(filters):
+            if f.edges is None:
+                continue
+            self.edge_start[i] = total
+            self.edge_count[i] = len(f.edges)
+            total += len(f.edges)
+            edges.extend(f.edges)
+        edges = np.array(edges, dtype=np.float64).reshape(-1, 4)
+        self.lon_i, self.lon_j, self.lat_i, self.slope = edges.T
+
+    def matrix(self, listings):
+        """Матрица совпадений (пользователи × объявления) и объявления, попавшие в неё.
+
+        Объявления без цены, площади, координат или даты в матрицу не входят.
+        """
+        listings = [listing for listing in listings
+                    if None not in (listing[3], listing[5], listing[7], listing[8], listing[9])]
+        result = np.zeros((len(self.filters), len(listings)), dtype=bool)
+        if not listings or not self.filters:
+            return result, listings
+
+        source = np.array([listing[0] for listing in listings], dtype=np.int64)
+        price = np.array([listing[3] for listing in listings], dtype=np.float64)
+        size = np.array([listing[5] for listing in listings], dtype=np.float64)
+        lat = np.array([listing[7] for listing in listings], dtype=np.float64)
+        lon = np.array([listing[8] for listing in listings], dtype=np.float64)
+        swap = np.array([listing[10] == 1 for listing in listings], dtype=bool)
+        wbs = np.array([listing[11] == 1 for listing in listings], dtype=bool)
+
+        # Всё, что не требует геометрии, — одной матрицей кандидатов
+        candidates = (self.sources[:, None] & (np.int64(1) << source)[None, :]) != 0
+        candidates &= ~(self.no_swap[:, None] & swap[None, :])
+        candidates &= ~(self.no_wbs[:, None] & wbs[None, :])
+        candidates &= (self.min_price[:, None] <= price) & (price <= self.max_price[:, None])
+        candidates &= (self.min_size[:, None] <= size) & (size <= self.max_size[:, None])
+        candidates &= (self.min_lat[:, None] <= lat) & (lat <= self.max_lat[:, None])
+        candidates &= (self.min_lon[:, None] <= lon) & (lon <= self.max_lon[:, None])
+
+        users, cols = np.nonzero(candidates)
+        circle = self.is_circle[users]
+        result[users[circle], cols[circle]] = self._in_circle(users[circle], lat[cols[circle]], lon[cols[circle]])
+        polygon = ~circle
+        result[users[polygon], cols[polygon]] = self._in_polygon(users[polygon], lat[cols[polygon]], lon[cols[polygon]])
+        return result, listings
+
+    def _in_circle(self, users, lat, lon):
+        lat_rad = np.radians(lat)
+        hav = (np.sin((lat_rad - self.circle_lat[users]) / 2) ** 2
+               + self.circle_cos[users] * np.cos(lat_rad) * np.sin((np.radians(lon) - self.circle_lon[users]) / 2) ** 2)
+        return hav <= self.circle_hav[users]
+
+    def _in_polygon(self, users, lat, lon):
+        """Трассировка луча по всем парам сразу: пара разворачивается в рёбра своего полигона"""
+        counts = self.edge_count[users]
+        if not len(users):
+            return np.zeros(0, dtype=bool)
+        pair = np.repeat(np.arange(len(users)), counts)
+        # Номер ребра внутри полигона пары: сквозной номер минус начало отрезка пары
+        offsets = np.cumsum(counts) - counts
+        edge = self.edge_start[users][pair] + np.arange(len(pair)) - offsets[pair]
+        lat_p, lon_p = lat[pair], lon[pair]
+        lon_i, lat_i = self.lon_i[edge], self.lat_i[edge]
+
+        straddles = (lon_i > lon_p) != (self.lon_j[edge] > lon_p)
+        crosses = straddles & (lat_p < self.slope[edge] * (lon_p - lon_i) + lat_i)
+        # Нечётное число пересечений — точка внутри
+        return np.bincount(pair, weights=crosses, minlength=len(users)) % 2 == 1
+
+    def match(self, listings):
+        """Пары (фильтр, объявление) — по объявлениям, внутри — в порядке фильтров"""
+        result, listings = self.matrix(listings)
+        cols, users = np.nonzero(result.T)
+        return [(self.filters[u], listings[c]) for c, u in zip(cols.tolist(), users.tolist())]
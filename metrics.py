@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# === Константы ===
+WINDOW_SIZE = int(os.getenv("METRICS_WINDOW", "1000"))
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+SNAPSHOT_FILE = os.getenv("METRICS_SNAPSHOT_FILE", "metrics_snapshot.json")
+SNAPSHOT_INTERVAL = int(os.getenv("METRICS_SNAPSHOT_INTERVAL", "60"))
+
+
+# === Скользящая гистограмма ===
+class RollingHistogram:
+    """Хранит последние WINDOW_SIZE замеров и считает по ним перцентили"""
+
+    def __init__(self, size=WINDOW_SIZE):
+        self.samples = deque(maxlen=size)
+        self.count = 0
+
+    def add(self, value):
+        self.samples.append(value)
+        self.count += 1
+
+    def summary(self):
+        values = sorted(self.samples)
+        if not values:
+            return {"count": self.count}
+
+        def pct(p):
+            return round(values[min(len(values) - 1, int(p * len(values)))] * 1000, 2)
+
+        return {
+            "count": self.count,
+            "p50_ms": pct(0.50),
+            "p95_ms": pct(0.95),
+            "p99_ms": pct(0.99),
+            "max_ms": round(values[-1] * 1000, 2),
+        }
+
+
+_lock = threading.Lock()
+_histograms = {}
+
+
+def record(stage, source, seconds):
+    """Добавляет замер длительности этапа stage для источника source"""
+    with _lock:
+        hist = _histograms.get((source, stage))
+        if hist is None:
+            hist = _histograms[(source, stage)] = RollingHistogram()
+        hist.add(seconds)
+
+
+@contextmanager
+def timer(stage, source):
+    """with timer("get_new_ids", "Immoscout"): ..."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, source, time.perf_counter() - start)
+
+
+def timed(stage, source):
+    """Декоратор: замеряет каждый вызов функции"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(stage, source):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def snapshot():
+    """{source: {stage: {count, p50_ms, p95_ms, p99_ms, max_ms}}}"""
+    with _lock:
+        items = list(_histograms.items())
+    result = {}
+    for (source, stage), hist in items:
+        result.setdefault(source, {})[stage] = hist.summary()
+    return result
+
+
+# === Экспорт ===
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.rstrip("/") != "/metrics":
+            self.send_error(404)
+            return
+        body = json.dumps(snapshot(), ensure_ascii=False, indent=2).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port=METRICS_PORT):
+    """Поднимает http://127.0.0.1:<port>/metrics; port=0 — выключено"""
+    if not port:
+        return None
+    server = ThreadingHTTPServer(("127.0.0.1", port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True, name="metrics-http").start()
+    logging.info(f"📈 Метрики доступны на http://127.0.0.1:{port}/metrics")
+    return server
+
+
+def write_snapshot(path=SNAPSHOT_FILE):
+    data = {"generated_at": int(time.time()), "stages": snapshot()}
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+
+def start_snapshot_writer(path=SNAPSHOT_FILE, interval=SNAPSHOT_INTERVAL):
+    """Раз в interval сек сохраняет снимок метрик в файл"""
+    def loop():
+        while True:
+            time.sleep(interval)
+            try:
+                write_snapshot(path)
+            except Exception as e:
+                logging.warning(f"⚠️ Не удалось сохранить метрики в {path}: {e}")
+
+    threading.Thread(target=loop, daemon=True, name="metrics-snapshot").start()
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from metrics import timer
+
+
+class SourceCancelled(BaseException):
+    """Источник превысил свой лимит времени и был остановлен.
+
+    Наследуется от BaseException (как asyncio.CancelledError), чтобы общие
+    `except Exception` внутри парсеров не проглатывали отмену.
+    """
+
+
+_local = threading.local()
+
+
+def check_cancelled():
+    """Вызывается парсерами между шагами: прерывает работу, если дедлайн источника истёк"""
+    event = getattr(_local, "cancel_event", None)
+    if event is not None and event.is_set():
+        raise SourceCancelled()
+
+
+# === Источник ===
+class Source:
+    def __init__(self, name, func, timeout):
+        self.name = name
+        self.func = func
+        self.timeout = timeout
+        self.cancel_event = threading.Event()
+        self.future = None
+        self.deadline = None
+
+    @property
+    def running(self):
+        return self.future is not None and not self.future.done()
+
+    def _call(self):
+        _local.cancel_event = self.cancel_event
+        try:
+            with timer("run", self.name):
+                return self.func()
+        finally:
+            _local.cancel_event = None
+
+
+# === Параллельный запуск источников ===
+class Orchestrator:
+    """Запускает источники параллельно, каждый со своим дедлайном"""
+
+    def __init__(self, sources, on_new=None, on_error=None):
+        self.sources = sources
+        self.on_new = on_new
+        self.on_error = on_error
+        self._executor = ThreadPoolExecutor(max_workers=len(sources), thread_name_prefix="source")
+        self._pending = {}
+
+    def submit(self, source):
+        """Стартует источник; возвращает False, если прошлый запуск ещё не завершился"""
+        if source.running:
+            # Прошлый запуск ещё не отреагировал на отмену — не плодим потоки
+            print(f"⏳ {source.name}: предыдущий запуск ещё не завершился, пропускаем")
+            return False
+        source.cancel_event = threading.Event()
+        source.deadline = time.monotonic() + source.timeout
+        source.future = self._executor.submit(source._call)
+        self._pending[source.future] = source
+        return True
+
+    @property
+    def busy(self):
+        return bool(self._pending)
+
+    def _report_error(self, name, error):
+        if self.on_error:
+            self.on_error(name, error)
+
+    def collect(self, timeout=None):
+        """Ждёт до timeout сек (не дольше ближайшего дедлайна) и разбирает завершившиеся источники.
+
+        on_new(name) вызывается сразу, как только источник вернул True.
+        Возвращает список (source, found_new) для завершённых и отменённых источников.
+        """
+        if not self._pending:
+            if timeout:
+                time.sleep(timeout)
+            return []
+
+        wait_for = min(s.deadline for s in self._pending.values()) - time.monotonic()
+        if timeout is not None:
+            wait_for = min(wait_for, timeout)
+        done, _ = wait(self._pending, timeout=max(0.0, wait_for), return_when=FIRST_COMPLETED)
+
+        finished = []
+        for future in done:
+            source = self._pending.pop(future)
+            found_new = False
+            try:
+                found_new = bool(future.result())
+            except SourceCancelled:
+                pass
+            except Exception as e:
+                self._report_error(source.name, e)
+            if found_new and self.on_new:
+                self.on_new(source.name)
+            finished.append((source, found_new))
+
+        now = time.monotonic()
+        for future, source in list(self._pending.items()):
+            if now >= source.deadline:
+                source.cancel_event.set()
+                del self._pending[future]
+                self._report_error(
+                    source.name,
+                    TimeoutError(f"Источник не уложился в {source.timeout} сек и был отменён")
+                )
+                finished.append((source, False))
+
+        return finished
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+import os
+import queue
+import threading
+import time
+from dotenv import load_dotenv
+
+load_dotenv()
+
+QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", "200"))
+MAX_BATCH = int(os.getenv("PIPELINE_MAX_BATCH", "50"))
+RETRY_DELAY = float(os.getenv("PIPELINE_RETRY_DELAY", "10"))  # пауза перед повтором упавшей пачки
+
+# Очередь между парсерами и рассылкой; None — рассылка в этом процессе не запущена
+_queue = None
+
+
+def publish(key):
+    """Передаёт только что сохранённое объявление (код источника, ID) в рассылку.
+
+    Очередь ограничена: если рассылка не успевает, парсер ждёт (backpressure).
+    Когда парсер запущен сам по себе, без рассылки, вызов ничего не делает.
+    """
+    if _queue is not None:
+        _queue.put(key)
+
+
+# === Поток доставки ===
+class DeliveryWorker(threading.Thread):
+    """Забирает объявления из очереди пачками и сразу отправляет их пользователям.
+
+    catch_up() выполняется при старте (до успеха) — досылает то, что было сохранено,
+    пока процесс не работал. С poll_interval он повторяется каждые poll_interval
+    сек: с общей базой объявления сохраняют и парсеры других узлов, а в очередь
+    этого процесса они не попадают. on_idle(moment) вызывается, когда очередь опустела:
+    всё, что сохранено до moment (UTC epoch), уже разослано. Пачка, на которой
+    handler упал (например, база занята), повторяется вместе со следующей, и
+    пока она не разослана, on_idle не вызывается — окно last_run её не пропустит.
+    """
+
+    def __init__(self, handler, catch_up=None, on_idle=None, on_error=None, poll_interval=None):
+        super().__init__(daemon=True, name="Рассылка Telegram")
+        self.handler = handler
+        self.catch_up = catch_up
+        self.poll_interval = poll_interval if catch_up else None
+        self.on_idle = on_idle
+        self.on_error = on_error
+        self.queue = queue.Queue(maxsize=QUEUE_SIZE)
+
+    def _report_error(self, error):
+        if self.on_error:
+            self.on_error(self.name, error)
+
+    def _next_batch(self, pending, timeout=None):
+        """Следующая пачка; [] — за timeout сек ничего не пришло"""
+        batch = list(pending)
+        if not batch:
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                return []
+        while len(batch) < MAX_BATCH:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        # Одно объявление могло прийти дважды (например, после повторного запуска)
+        return list(dict.fromkeys(batch))
+
+    def run(self):
+        # Без удачного catch_up окно last_run нельзя сдвигать — повторяем, пока не пройдёт
+        while self.catch_up:
+            try:
+                self.catch_up()
+                break
+            except Exception as e:
+                self._report_error(e)
+                time.sleep(RETRY_DELAY)
+
+        pending = []
+        next_poll = time.monotonic() + self.poll_interval if self.poll_interval else None
+        while True:
+            timeout = None
+            if next_poll is not None:
+                if time.monotonic() >= next_poll:
+                    # Не удался — окно не сдвинулось, следующий опрос захватит то же
+                    try:
+                        self.catch_up()
+                    except Exception as e:
+                        self._report_error(e)
+                    next_poll = time.monotonic() + self.poll_interval
+                timeout = max(0.0, next_poll - time.monotonic())
+
+            batch = self._next_batch(pending, timeout)
+            if not batch:
+                continue
+            started = int(time.time())
+            try:
+                self.handler(batch)
+            except Exception as e:
+                self._report_error(e)
+                pending = batch
+                time.sleep(RETRY_DELAY)
+                continue
+            pending = []
+            if self.on_idle and self.queue.empty():
+                try:
+                    self.on_idle(started)
+                except Exception as e:
+                    self._report_error(e)
+
+
+def start_delivery(handler, catch_up=None, on_idle=None, on_error=None, poll_interval=None):
+    """Запускает поток доставки и подключает к нему publish()"""
+    global _queue
+    worker = DeliveryWorker(handler, catch_up=catch_up, on_idle=on_idle, on_error=on_error,
+                            poll_interval=poll_interval)
+    _queue = worker.queue
+    worker.start()
+    return worker
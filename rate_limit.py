@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import threading
+import time
+
+
+class TokenBucket:
+    """Потокобезопасный token bucket: в среднем rate запросов в секунду, всплеск до capacity"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(1.0, self.rate))
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self, tokens):
+        """Забирает токены (можно в долг) и возвращает, сколько ждать до их появления"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= tokens
+            return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    def acquire(self, tokens=1):
+        delay = self._reserve(tokens)
+        if delay > 0:
+            time.sleep(delay)
+
+    async def wait(self, tokens=1):
+        """acquire для asyncio: ждёт, не блокируя цикл событий"""
+        delay = self._reserve(tokens)
+        if delay > 0:
+            await asyncio.sleep(delay)
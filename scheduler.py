@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+import time
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+BERLIN_TZ = ZoneInfo("Europe/Berlin")
+
+
+# === Адаптивный интервал опроса ===
+class AdaptiveInterval:
+    """Интервал опроса источника между min и max, зависящий от того, как часто он находит новое.
+
+    Доля «удачных» запусков хранится двумя скользящими средними (EWMA): общая
+    за последние запуски и отдельно для каждого часа суток по Берлину. Берётся
+    большая из двух — источник ускоряется сразу после находки и заранее
+    в те часы, когда обычно публикуют много объявлений.
+    """
+
+    def __init__(self, min_interval, max_interval, alpha=0.3, hourly_alpha=0.1):
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.alpha = alpha
+        self.hourly_alpha = hourly_alpha
+        self.recent_rate = 0.5
+        self.hourly_rate = [0.5] * 24
+
+    def record(self, found_new, now=None):
+        hit = 1.0 if found_new else 0.0
+        hour = (now or datetime.now(BERLIN_TZ)).hour
+        self.recent_rate += self.alpha * (hit - self.recent_rate)
+        self.hourly_rate[hour] += self.hourly_alpha * (hit - self.hourly_rate[hour])
+
+    def current(self, now=None):
+        hour = (now or datetime.now(BERLIN_TZ)).hour
+        rate = max(self.recent_rate, self.hourly_rate[hour])
+        return self.min_interval + (self.max_interval - self.min_interval) * (1.0 - rate)
+
+
+# === Планировщик источников ===
+class Scheduler:
+    """Запускает каждый источник через Orchestrator по его собственному интервалу"""
+
+    def __init__(self, orchestrator, intervals):
+        self.orchestrator = orchestrator
+        self.intervals = intervals
+        self.next_run = {source.name: 0.0 for source in orchestrator.sources}
+
+    def _due(self, now):
+        return [s for s in self.orchestrator.sources
+                if now >= self.next_run[s.name] and not s.running]
+
+    def tick(self):
+        now = time.monotonic()
+        for source in self._due(now):
+            if self.orchestrator.submit(source):
+                # Пока источник работает, повторно его не запускаем
+                self.next_run[source.name] = float("inf")
+
+        waiting = [t for t in self.next_run.values() if t != float("inf")]
+        timeout = min(waiting) - time.monotonic() if waiting else None
+        if timeout is not None and timeout <= 0:
+            # Источник пора запускать, но он ещё не отреагировал на отмену —
+            # о его завершении уведомления не будет, проверяем раз в секунду
+            timeout = 1.0
+
+        for source, found_new in self.orchestrator.collect(timeout):
+            interval = self.intervals[source.name]
+            interval.record(found_new)
+            delay = interval.current()
+            self.next_run[source.name] = time.monotonic() + delay
+            print(f"🔁 {source.name}: следующий опрос через {round(delay)} сек")
@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""PostgreSQL-бэкенд storage (STORAGE_BACKEND=postgres, DATABASE_URL=postgresql://...).
+
+Запросы в проекте написаны под SQLite с плейсхолдерами "?": обёртки ниже
+переводят их в "%s" и ведут себя как sqlite3.Connection (in_transaction,
+with conn: — commit/rollback без закрытия), так что остальной код не знает,
+какая база под ним.
+"""
+import logging
+
+try:
+    import psycopg
+    from psycopg.pq import TransactionStatus
+except ImportError as e:
+    raise ImportError("STORAGE_BACKEND=postgres требует пакет psycopg: pip install 'psycopg[binary]'") from e
+
+Error = psycopg.Error
+SCHEMA_LOCK_ID = 7_201_455  # pg_advisory_xact_lock: мигрирует один узел
+
+
+def _translate(query):
+    # % в тексте запроса psycopg считает плейсхолдером — экранируем
+    return query.replace("%", "%%").replace("?", "%s")
+
+
+class PostgresCursor:
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def execute(self, query, params=None):
+        if params is None:
+            self._cursor.execute(query)
+        else:
+            self._cursor.execute(_translate(query), params)
+        return self
+
+    def executemany(self, query, params_seq):
+        self._cursor.executemany(_translate(query), params_seq)
+        return self
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class PostgresConnection:
+    def __init__(self, conn):
+        self._conn = conn
+
+    def cursor(self):
+        return PostgresCursor(self._conn.cursor())
+
+    def execute(self, query, params=None):
+        return self.cursor().execute(query, params)
+
+    @property
+    def in_transaction(self):
+        return self._conn.info.transaction_status != TransactionStatus.IDLE
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # Как у sqlite3: завершить транзакцию, но соединение оставить открытым
+        if exc_type is None:
+            self._conn.commit()
+        else:
+            self._conn.rollback()
+        return False
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+# === Схема ===
+def _migration_schema(cursor):
+    """схема, равная SQLite-версии 5: listings (source, id), epoch-время, индексы горячих запросов"""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS listings (
+            source SMALLINT NOT NULL,
+            id TEXT NOT NULL,
+            url TEXT,
+            price DOUBLE PRECISION,
+            price_warm DOUBLE PRECISION,
+            size DOUBLE PRECISION,
+            address TEXT,
+            lat DOUBLE PRECISION,
+            lon DOUBLE PRECISION,
+            swapflat INTEGER,
+            wbs_required INTEGER,
+            created_at BIGINT,
+            photo_url TEXT,
+            is_active TEXT,
+            last_checked BIGINT,
+            PRIMARY KEY (source, id)
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_listings_created_at ON listings (created_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_listings_last_checked ON listings (last_checked)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_listings_cleaner ON listings (is_active, source, id) INCLUDE (url)")
+
+    # Флаги — INTEGER, а не BOOLEAN: запросы сравнивают их с 0/1, как в SQLite
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            id BIGINT PRIMARY KEY,
+            first_name TEXT,
+            last_name TEXT,
+            username TEXT,
+            language TEXT DEFAULT 'en',
+            location TEXT,
+            min_price INTEGER DEFAULT NULL,
+            max_price INTEGER DEFAULT NULL,
+            min_size INTEGER DEFAULT NULL,
+            max_size INTEGER DEFAULT NULL,
+            tauschwohnung INTEGER DEFAULT 0,
+            wbs INTEGER DEFAULT 0,
+            use_immoscout INTEGER DEFAULT 1,
+            use_kleinanzeigen INTEGER DEFAULT 1,
+            use_immowelt INTEGER DEFAULT 1,
+            subscribed_until TEXT,
+            is_searching INTEGER DEFAULT 0,
+            referred_by BIGINT DEFAULT NULL,
+            use_inberlinwohnen INTEGER DEFAULT 1
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_searching ON users (id) WHERE is_searching = 1")
+
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS run_metadata (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS sent_listings (
+            user_id BIGINT NOT NULL,
+            source SMALLINT NOT NULL,
+            listing_id TEXT NOT NULL,
+            url TEXT,
+            sent_at TEXT,
+            PRIMARY KEY (user_id, source, listing_id)
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_sent_listings_listing ON sent_listings (source, listing_id)")
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS subscription_notifications (
+            user_id BIGINT PRIMARY KEY,
+            last_warned TEXT
+        )
+    """)
+
+
+def _migration_table_versions(cursor):
+    """счётчик изменений users (триггер) — кэш фильтров рассылки пересобирается только по нему"""
+    cursor.execute("CREATE TABLE table_versions (name TEXT PRIMARY KEY, version BIGINT NOT NULL)")
+    cursor.execute("INSERT INTO table_versions (name, version) VALUES ('users', 0)")
+    cursor.execute("""
+        CREATE FUNCTION bump_users_version() RETURNS trigger AS $$
+        BEGIN
+            UPDATE table_versions SET version = version + 1 WHERE name = 'users';
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+    """)
+    cursor.execute("""
+        CREATE TRIGGER users_version AFTER INSERT OR UPDATE OR DELETE ON users
+        FOR EACH STATEMENT EXECUTE FUNCTION bump_users_version()
+    """)
+
+
+# Номер миграции = позиция в списке + 1, хранится в schema_version
+MIGRATIONS = [
+    _migration_schema,
+    _migration_table_versions,
+]
+
+
+class PostgresBackend:
+    """Общая база для нескольких машин: парсеры, рассылка и бот могут жить раздельно"""
+
+    shared = True
+
+    def __init__(self, url):
+        if not url:
+            raise ValueError("STORAGE_BACKEND=postgres, но DATABASE_URL не задан")
+        self.url = url
+        self.key = url
+
+    def open(self):
+        return PostgresConnection(psycopg.connect(self.url))
+
+    def schema_version(self, conn):
+        row = conn.execute("SELECT MAX(version) FROM schema_version").fetchone()
+        return row[0] or 0
+
+    def begin(self, conn):
+        # psycopg сам открывает транзакцию на первом запросе
+        pass
+
+    def init_schema(self):
+        conn = self.open()
+        try:
+            conn.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)")
+            conn.commit()
+            while True:
+                with conn:
+                    conn.execute("SELECT pg_advisory_xact_lock(?)", (SCHEMA_LOCK_ID,))
+                    version = self.schema_version(conn)
+                    if version >= len(MIGRATIONS):
+                        return version
+                    migration = MIGRATIONS[version]
+                    migration(conn.cursor())
+                    conn.execute("INSERT INTO schema_version (version) VALUES (?)", (version + 1,))
+                logging.info(f"🛠️ Миграция PostgreSQL {version + 1}: {migration.__doc__}")
+        finally:
+            conn.close()
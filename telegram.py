@@ -1,5 +1,4 @@
 # -*- coding: utf-8 -*-
-import sqlite3
 import json
 import logging
 import os
@@ -16,6 +15,9 @@ from aiogram.fsm.storage.memory import MemoryStorage
 from zoneinfo import ZoneInfo
 from dotenv import load_dotenv
 
+from storage import connect, release, init_db, write, execute_write, LAST_WARNED_QUERY, DatabaseError
+from matching import simplify_polygon
+
 # === Load environment ===
 load_dotenv()
 
@@ -299,67 +301,19 @@ translations = {
     }
 }
 
-# === Create users table ===
-def create_users_table():
-    conn = sqlite3.connect("seen_ids.db")
-    cursor = conn.cursor()
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY,
-            first_name TEXT,
-            last_name TEXT,
-            username TEXT,
-            language TEXT DEFAULT 'en',
-            location TEXT,
-            min_price INTEGER DEFAULT NULL,
-            max_price INTEGER DEFAULT NULL,
-            min_size INTEGER DEFAULT NULL,
-            max_size INTEGER DEFAULT NULL,
-            tauschwohnung BOOLEAN DEFAULT 0,
-            wbs BOOLEAN DEFAULT 0,
-            use_immoscout BOOLEAN DEFAULT 1,
-            use_kleinanzeigen BOOLEAN DEFAULT 1,
-            use_immowelt BOOLEAN DEFAULT 1,
-            subscribed_until TEXT,
-            is_searching BOOLEAN DEFAULT 0,
-            referred_by INTEGER DEFAULT NULL,
-            use_inberlinwohnen BOOLEAN DEFAULT 1
-        )
-    """)
-
-    # Add missing columns if they don't exist
-    for column, col_type in [
-        ("first_name", "TEXT"),
-        ("last_name", "TEXT"),
-        ("username", "TEXT"),
-        ("language", "TEXT DEFAULT 'en'"),
-        ("referred_by", "INTEGER DEFAULT NULL"),
-        ("use_inberlinwohnen", "BOOLEAN DEFAULT 1")
-    ]:
-        try:
-            cursor.execute(f"ALTER TABLE users ADD COLUMN {column} {col_type}")
-        except sqlite3.OperationalError:
-            pass
-    conn.commit()
-    conn.close()
-
 # === Language management ===
 def get_user_language(user_id):
-    conn = sqlite3.connect("seen_ids.db")
+    conn = connect()
     cursor = conn.cursor()
     cursor.execute("SELECT language FROM users WHERE id = ?", (user_id,))
     row = cursor.fetchone()
-    conn.close()
+    release(conn)
     return row[0] if row and row[0] in SUPPORTED_LANGUAGES else DEFAULT_LANGUAGE
 
-def set_user_language(user_id, lang):
+async def set_user_language(user_id, lang):
     if lang not in SUPPORTED_LANGUAGES:
         return
-    conn = sqlite3.connect("seen_ids.db")
-    cursor = conn.cursor()
-    cursor.execute("UPDATE users SET language = ? WHERE id = ?", (lang, user_id))
-    conn.commit()
-    conn.close()
+    await asyncio.wrap_future(execute_write("UPDATE users SET language = ? WHERE id = ?", (lang, user_id)))
 
 def get_language_keyboard():
     return ReplyKeyboardMarkup(keyboard=[
@@ -390,83 +344,72 @@ def sanitize(text):
     return text.encode('utf-16', 'surrogatepass').decode('utf-16', 'ignore')
 
 # === Add user if not exists ===
-async def add_user_to_db(user: types.User, referrer_id=None):
-    conn = sqlite3.connect("seen_ids.db")
-    cursor = conn.cursor()
-
-    cursor.execute("SELECT id FROM users WHERE id = ?", (user.id,))
+def _upsert_user(cursor, user_id, first_name, last_name, username, referrer_id):
+    """Runs in the DB writer thread; returns the referrer's language if they got a bonus"""
+    cursor.execute("SELECT id FROM users WHERE id = ?", (user_id,))
     row = cursor.fetchone()
 
-    if row is None:
-        # New user - trial period + referral
-        trial_end = datetime.now() + timedelta(days=7)
-        cursor.execute("""
-            INSERT INTO users (id, first_name, last_name, username, subscribed_until, is_searching, referred_by)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        """, (
-            user.id,
-            sanitize(user.first_name),
-            sanitize(user.last_name),
-            user.username,
-            trial_end.isoformat(),
-            0,
-            referrer_id
-        ))
-        logger.info(f"[DB] New user added: {user.id} (referred_by={referrer_id})")
-
-        # Bonus for referrer
-        if referrer_id and referrer_id != user.id:
-            cursor.execute("SELECT subscribed_until, language FROM users WHERE id = ?", (referrer_id,))
-            ref_row = cursor.fetchone()
-            if ref_row:
-                try:
-                    current_sub = datetime.fromisoformat(ref_row[0]) if ref_row[0] else datetime.now()
-                except Exception:
-                    current_sub = datetime.now()
-
-                bonus_sub = current_sub + timedelta(days=14)
-                cursor.execute("UPDATE users SET subscribed_until = ? WHERE id = ?",
-                               (bonus_sub.isoformat(), referrer_id))
-                logger.info(f"[REFERRAL] User {referrer_id} got +14 days for inviting {user.id}")
-
-                # Notification to referrer
-                ref_lang = ref_row[1] if ref_row[1] in SUPPORTED_LANGUAGES else DEFAULT_LANGUAGE
-                try:
-                    await bot.send_message(
-                        chat_id=referrer_id,
-                        text=translations[ref_lang]["referral"]["success"].format(
-                            days=14,
-                            new_user=user.first_name or "New user"
-                        ),
-                        parse_mode="Markdown"
-                    )
-                except Exception as e:
-                    logger.error(f"[REFERRAL] Error sending notification to {referrer_id}: {e}")
-            else:
-                logger.warning(f"[REFERRAL] Referrer {referrer_id} not found.")
-    else:
+    if row is not None:
         # Existing user - update name/username
         cursor.execute("""
             UPDATE users SET first_name = ?, last_name = ?, username = ? WHERE id = ?
-        """, (
-            sanitize(user.first_name),
-            sanitize(user.last_name),
-            user.username,
-            user.id
-        ))
-        logger.info(f"[DB] Existing user {user.id} info updated.")
+        """, (first_name, last_name, username, user_id))
+        logger.info(f"[DB] Existing user {user_id} info updated.")
+        return None
+
+    # New user - trial period + referral
+    trial_end = datetime.now() + timedelta(days=7)
+    cursor.execute("""
+        INSERT INTO users (id, first_name, last_name, username, subscribed_until, is_searching, referred_by)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    """, (user_id, first_name, last_name, username, trial_end.isoformat(), 0, referrer_id))
+    logger.info(f"[DB] New user added: {user_id} (referred_by={referrer_id})")
+
+    # Bonus for referrer
+    if not referrer_id or referrer_id == user_id:
+        return None
+    cursor.execute("SELECT subscribed_until, language FROM users WHERE id = ?", (referrer_id,))
+    ref_row = cursor.fetchone()
+    if not ref_row:
+        logger.warning(f"[REFERRAL] Referrer {referrer_id} not found.")
+        return None
+    try:
+        current_sub = datetime.fromisoformat(ref_row[0]) if ref_row[0] else datetime.now()
+    except Exception:
+        current_sub = datetime.now()
 
-    conn.commit()
-    conn.close()
+    bonus_sub = current_sub + timedelta(days=14)
+    cursor.execute("UPDATE users SET subscribed_until = ? WHERE id = ?",
+                   (bonus_sub.isoformat(), referrer_id))
+    logger.info(f"[REFERRAL] User {referrer_id} got +14 days for inviting {user_id}")
+    return ref_row[1] if ref_row[1] in SUPPORTED_LANGUAGES else DEFAULT_LANGUAGE
+
+async def add_user_to_db(user: types.User, referrer_id=None):
+    ref_lang = await asyncio.wrap_future(write(
+        _upsert_user, user.id, sanitize(user.first_name), sanitize(user.last_name), user.username, referrer_id
+    ))
+
+    # Notification to referrer
+    if ref_lang:
+        try:
+            await bot.send_message(
+                chat_id=referrer_id,
+                text=translations[ref_lang]["referral"]["success"].format(
+                    days=14,
+                    new_user=user.first_name or "New user"
+                ),
+                parse_mode="Markdown"
+            )
+        except Exception as e:
+            logger.error(f"[REFERRAL] Error sending notification to {referrer_id}: {e}")
 
 # === Save user filters ===
-def save_user_filters(user_id, location, min_price, max_price, min_size, max_size,
+async def save_user_filters(user_id, location, min_price, max_price, min_size, max_size,
                       tauschwohnung=False, wbs=False,
                       use_immoscout=True, use_kleinanzeigen=True, use_immowelt=True, use_inberlinwohnen=True):
+    """Сохраняет фильтры; False, если записать не удалось"""
     try:
-        conn = sqlite3.connect("seen_ids.db")
-        cursor = conn.cursor()
-        cursor.execute("""
+        await asyncio.wrap_future(execute_write("""
             INSERT INTO users (id, location, min_price, max_price, min_size, max_size,
                               tauschwohnung, wbs,
                               use_immoscout, use_kleinanzeigen, use_immowelt, use_inberlinwohnen)
@@ -484,12 +427,14 @@ def save_user_filters(user_id, location, min_price, max_price, min_size, max_siz
                 use_immowelt = excluded.use_immowelt,
                 use_inberlinwohnen = excluded.use_inberlinwohnen
         """, (user_id, location, min_price, max_price, min_size, max_size,
-              tauschwohnung, wbs, use_immoscout, use_kleinanzeigen, use_immowelt, use_inberlinwohnen))
-        conn.commit()
-        conn.close()
+              # Флаги — INTEGER 0/1: bool PostgreSQL в integer сам не приводит
+              int(tauschwohnung), int(wbs), int(use_immoscout), int(use_kleinanzeigen),
+              int(use_immowelt), int(use_inberlinwohnen))))
         logger.info(f"[DB] User {user_id} filters updated")
-    except sqlite3.Error as e:
+        return True
+    except DatabaseError as e:
         logger.error(f"[DB] Error saving filters: {e}")
+        return False
 
 # === Menu actions for all languages ===
 MENU_ACTIONS = {
@@ -608,14 +553,14 @@ async def select_language(message: types.Message):
         "🇹🇷 Türkçe": "tr"
     }
     lang = lang_map.get(message.text, DEFAULT_LANGUAGE)
-    set_user_language(user_id, lang)
+    await set_user_language(user_id, lang)
     await add_user_to_db(message.from_user)
 
-    conn = sqlite3.connect("seen_ids.db")
+    conn = connect()
     cursor = conn.cursor()
     cursor.execute("SELECT subscribed_until FROM users WHERE id = ?", (user_id,))
     row = cursor.fetchone()
-    conn.close()
+    release(conn)
 
     trial_end_text = ""
     if row and row[0]:
@@ -668,11 +613,11 @@ async def pre_checkout_query(query: PreCheckoutQuery):
 
 # === Check subscription status ===
 def check_subscription(user_id):
-    conn = sqlite3.connect("seen_ids.db")
+    conn = connect()
     cursor = conn.cursor()
     cursor.execute("SELECT subscribed_until, is_searching FROM users WHERE id = ?", (user_id,))
     row = cursor.fetchone()
-    conn.close()
+    release(conn)
 
     if not row or not row[0]:
         return False
@@ -682,11 +627,7 @@ def check_subscription(user_id):
         now = datetime.now()
         if sub_until < now:
             # Subscription expired, disable searching
-            conn = sqlite3.connect("seen_ids.db")
-            cursor = conn.cursor()
-            cursor.execute("UPDATE users SET is_searching = 0 WHERE id = ?", (user_id,))
-            conn.commit()
-            conn.close()
+            execute_write("UPDATE users SET is_searching = 0 WHERE id = ?", (user_id,))
             return False
         return True
     except Exception as e:
@@ -708,11 +649,11 @@ def get_subscription_warning_message(subscribed_until: datetime, lang: str) -> s
 async def my_subscription_handler(message: types.Message):
     user_id = message.chat.id
     lang = get_user_language(user_id)
-    conn = sqlite3.connect("seen_ids.db")
+    conn = connect()
     cursor = conn.cursor()
     cursor.execute("SELECT subscribed_until FROM users WHERE id = ?", (user_id,))
     row = cursor.fetchone()
-    conn.close()
+    release(conn)
 
     if row and row[0]:
         try:
@@ -741,14 +682,8 @@ async def my_subscription_handler(message: types.Message):
             parse_mode="Markdown"
         )
 
-@dp.message(F.successful_payment)
-async def handle_successful_payment(message: types.Message):
-    user_id = message.chat.id
-    lang = get_user_language(user_id)
-    now = datetime.now()
-
-    conn = sqlite3.connect("seen_ids.db")
-    cursor = conn.cursor()
+def _extend_subscription(cursor, user_id, now):
+    """Runs in the DB writer thread: read and update in one transaction"""
     cursor.execute("SELECT subscribed_until FROM users WHERE id = ?", (user_id,))
     row = cursor.fetchone()
 
@@ -766,8 +701,13 @@ async def handle_successful_payment(message: types.Message):
         new_until = now + timedelta(days=30)
 
     cursor.execute("UPDATE users SET subscribed_until = ? WHERE id = ?", (new_until.isoformat(), user_id))
-    conn.commit()
-    conn.close()
+    return new_until
+
+@dp.message(F.successful_payment)
+async def handle_successful_payment(message: types.Message):
+    user_id = message.chat.id
+    lang = get_user_language(user_id)
+    new_until = await asyncio.wrap_future(write(_extend_subscription, user_id, datetime.now()))
 
     await message.answer(
         translations[lang]["subscription"]["activated"].format(
@@ -833,7 +773,16 @@ async def webapp_data_handler(message: types.Message):
         if loc["type"] == "circle":
             location_text = f"{loc['center'][0]}, {loc['center'][1]}, {loc['radius']}"
         elif loc["type"] == "polygon":
-            location_text = "; ".join([f"{p[0]}, {p[1]}" for p in loc["coordinates"]])
+            # Контур упрощаем один раз здесь: рассылка проверяет каждую вершину на каждое объявление
+            try:
+                points = simplify_polygon([(float(p[0]), float(p[1])) for p in loc["coordinates"]])
+            except (ValueError, TypeError, IndexError):
+                await message.answer(translations[lang]["data_error"])
+                return
+            if len(points) < len(loc["coordinates"]):
+                logger.info(f"[WEBAPP] Polygon of {message.from_user.id} simplified: "
+                            f"{len(loc['coordinates'])} -> {len(points)} points")
+            location_text = "; ".join(f"{lat}, {lon}" for lat, lon in points)
 
     try:
         min_price = int(float(price[0])) if price and len(price) > 0 and price[0] else None
@@ -844,7 +793,7 @@ async def webapp_data_handler(message: types.Message):
         await message.answer(translations[lang]["data_error"])
         return
 
-    save_user_filters(
+    saved = await save_user_filters(
         user_id=user_id,
         location=location_text,
         min_price=min_price,
@@ -858,13 +807,12 @@ async def webapp_data_handler(message: types.Message):
         use_immowelt=use_immowelt,
         use_inberlinwohnen=use_inberlinwohnen
     )
+    if not saved:
+        await message.answer(translations[lang]["data_error"])
+        return
 
     # Enable is_searching after filters set
-    conn = sqlite3.connect("seen_ids.db")
-    cursor = conn.cursor()
-    cursor.execute("UPDATE users SET is_searching = 1 WHERE id = ?", (user_id,))
-    conn.commit()
-    conn.close()
+    await asyncio.wrap_future(execute_write("UPDATE users SET is_searching = 1 WHERE id = ?", (user_id,)))
     logger.info(f"[DB] Search enabled after setting filters for user {user_id}")
 
     tauschwohnung_text = translations[lang]["filters"]["yes"] if tauschwohnung else translations[lang]["filters"]["no"]
@@ -919,13 +867,14 @@ async def handle_menu_actions(message: types.Message):
             return
 
     if action == "start_search":
-        conn = sqlite3.connect("seen_ids.db")
+        conn = connect()
         cursor = conn.cursor()
         cursor.execute("""
             SELECT location, use_immoscout, use_kleinanzeigen, use_immowelt
             FROM users WHERE id = ?
         """, (user_id,))
         row = cursor.fetchone()
+        release(conn)
         if not row:
             await message.answer("⚠️ User not found in database.")
             return
@@ -939,18 +888,12 @@ async def handle_menu_actions(message: types.Message):
             )
             return
 
-        cursor.execute("UPDATE users SET is_searching = 1 WHERE id = ?", (user_id,))
-        conn.commit()
-        conn.close()
+        await asyncio.wrap_future(execute_write("UPDATE users SET is_searching = 1 WHERE id = ?", (user_id,)))
         logger.info(f"[DB] User {user_id} started search.")
         await message.answer(translations[lang]["search"]["started"])
 
     elif action == "stop_search":
-        conn = sqlite3.connect("seen_ids.db")
-        cursor = conn.cursor()
-        cursor.execute("UPDATE users SET is_searching = 0 WHERE id = ?", (user_id,))
-        conn.commit()
-        conn.close()
+        await asyncio.wrap_future(execute_write("UPDATE users SET is_searching = 0 WHERE id = ?", (user_id,)))
         logger.info(f"[DB] User {user_id} stopped search.")
         await message.answer(translations[lang]["search"]["stopped"])
 
@@ -1001,7 +944,7 @@ async def subscription_reminder_loop():
             today_str = now.strftime('%Y-%m-%d')
 
             # Получаем список всех пользователей заранее
-            with sqlite3.connect("seen_ids.db") as conn:
+            with connect() as conn:
                 cursor = conn.cursor()
                 cursor.execute("SELECT id, subscribed_until, language FROM users")
                 users = cursor.fetchall()
@@ -1023,22 +966,22 @@ async def subscription_reminder_loop():
                         continue
 
                     try:
-                        with sqlite3.connect("seen_ids.db") as conn:
-                            cursor = conn.cursor()
-                            cursor.execute("SELECT last_warned FROM subscription_notifications WHERE user_id = ?", (user_id,))
-                            row = cursor.fetchone()
-                            if row and row[0] == today_str:
-                                continue  # Уже отправляли сегодня
-
-                            await bot.send_message(user_id, warning_text)
-                            logger.info(f"[REMINDER] Sent to {user_id}: {warning_text}")
-
-                            cursor.execute("""
-                                INSERT INTO subscription_notifications (user_id, last_warned)
-                                VALUES (?, ?)
-                                ON CONFLICT(user_id) DO UPDATE SET last_warned = excluded.last_warned
-                            """, (user_id, today_str))
-                            conn.commit()
+                        conn = connect()
+                        cursor = conn.cursor()
+                        cursor.execute(LAST_WARNED_QUERY, (user_id,))
+                        row = cursor.fetchone()
+                        release(conn)
+                        if row and row[0] == today_str:
+                            continue  # Уже отправляли сегодня
+
+                        await bot.send_message(user_id, warning_text)
+                        logger.info(f"[REMINDER] Sent to {user_id}: {warning_text}")
+
+                        await asyncio.wrap_future(execute_write("""
+                            INSERT INTO subscription_notifications (user_id, last_warned)
+                            VALUES (?, ?)
+                            ON CONFLICT(user_id) DO UPDATE SET last_warned = excluded.last_warned
+                        """, (user_id, today_str)))
 
                     except Exception as e:
                         logger.warning(f"[REMINDER] Failed for {user_id}: {e}")
@@ -1058,7 +1001,7 @@ async def subscription_reminder_loop():
 
 # === Entry point ===
 async def main():
-    create_users_table()
+    init_db()
     await bot.delete_webhook(drop_pending_updates=True)
     logger.info("✅ Bot started with Help support.")
 
@@ -1089,11 +1032,11 @@ async def fallback_handler(message: types.Message):
         return  # Ignore commands like /start
 
     # Check if user exists in DB
-    conn = sqlite3.connect("seen_ids.db")
+    conn = connect()
     cursor = conn.cursor()
     cursor.execute("SELECT id FROM users WHERE id = ?", (user_id,))
     user_exists = cursor.fetchone()
-    conn.close()
+    release(conn)
 
     if not user_exists:
         await add_user_to_db(message.from_user)
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""Асинхронная отправка сообщений Telegram Bot API с соблюдением лимитов.
+
+Запросы идут из одного цикла asyncio в своём потоке через общую
+aiohttp-сессию с пулом соединений. Общий token bucket держит скорость
+бота ниже лимита Telegram (~30 сообщений/с), у каждого чата — свой
+(1 сообщение/с). Сообщения одному чату уходят по порядку, разным чатам —
+параллельно. На 429 ждём retry_after из ответа и повторяем, а не теряем
+сообщение.
+"""
+import asyncio
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from dotenv import load_dotenv
+
+import aiohttp
+
+from metrics import record
+from rate_limit import TokenBucket
+
+# === Загрузка .env ===
+load_dotenv()
+
+# === Константы ===
+GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "25"))  # запросов/с на весь бот
+CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))  # запросов/с в один чат
+MAX_IN_FLIGHT = int(os.getenv("TELEGRAM_MAX_IN_FLIGHT", "50"))  # одновременных запросов
+MAX_RETRIES = int(os.getenv("TELEGRAM_MAX_RETRIES", "5"))  # повторов после 429
+REQUEST_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "15"))
+
+
+class TelegramDelivery(threading.Thread):
+    """Поток с циклом asyncio и общей aiohttp-сессией.
+
+    send_all() вызывается из обычного потока и ждёт, пока уйдёт вся пачка.
+    Интервалы чатов живут между пачками: потоковая рассылка шлёт часто и понемногу.
+    """
+
+    def __init__(self, global_rate=GLOBAL_RATE, chat_rate=CHAT_RATE, max_in_flight=MAX_IN_FLIGHT):
+        super().__init__(daemon=True, name="Отправка Telegram")
+        self.loop = asyncio.new_event_loop()
+        self.global_limiter = TokenBucket(rate=global_rate)
+        self.chat_interval = 1 / chat_rate
+        self.chat_next = {}  # chat_id -> когда (monotonic) можно следующее сообщение
+        self.max_in_flight = max_in_flight
+        self.session = None
+        self._in_flight = None
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    async def _ensure_session(self):
+        if self.session is None:
+            connector = aiohttp.TCPConnector(limit=self.max_in_flight, ttl_dns_cache=300)
+            self.session = aiohttp.ClientSession(connector=connector,
+                                                 timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT))
+            self._in_flight = asyncio.Semaphore(self.max_in_flight)
+
+    async def _wait_chat(self, chat_id):
+        delay = self.chat_next.get(chat_id, 0.0) - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def _post(self, chat_id, url, payload):
+        """Один запрос с повторами на 429; (status, текст ответа)"""
+        for attempt in range(MAX_RETRIES + 1):
+            await self._wait_chat(chat_id)
+            # Альбом Telegram считает по фото: sendMediaGroup из 10 фото — 10 сообщений лимита
+            await self.global_limiter.wait(len(payload.get("media", ())) or 1)
+            async with self._in_flight:
+                # Интервал чата отсчитываем от фактической отправки, а не от начала ожидания:
+                # иначе очередь к общему лимиту съедает паузу между сообщениями одному чату
+                self.chat_next[chat_id] = time.monotonic() + self.chat_interval
+                started = time.perf_counter()
+                async with self.session.post(url, json=payload) as response:
+                    status, text = response.status, await response.text()
+                record("telegram_send", "Sender", time.perf_counter() - started)
+            if status != 429 or attempt == MAX_RETRIES:
+                return status, text
+            retry_after = _retry_after(text)
+            logging.warning(f"⏳ Telegram 429 для чата {chat_id}: повтор через {retry_after} с")
+            await asyncio.sleep(retry_after)
+
+    async def _send_chat(self, chat_id, jobs, results):
+        # Сообщения одному чату — строго по очереди, чтобы не путать порядок и не ловить 429
+        for url, payload, context in jobs:
+            try:
+                status, text = await self._post(chat_id, url, payload)
+            except Exception as e:
+                status, text = None, repr(e)
+            results.put((chat_id, context, status, text))
+
+    async def _send_all(self, jobs, results):
+        await self._ensure_session()
+        # Чаты, чья пауза уже прошла, ждать не нужно — не копим их между пачками
+        now = time.monotonic()
+        self.chat_next = {chat_id: at for chat_id, at in self.chat_next.items() if at > now}
+        by_chat = {}
+        for chat_id, url, payload, context in jobs:
+            by_chat.setdefault(chat_id, []).append((url, payload, context))
+        await asyncio.gather(*(self._send_chat(chat_id, chat_jobs, results)
+                               for chat_id, chat_jobs in by_chat.items()))
+
+    def send_all(self, jobs, on_result):
+        """Отправляет jobs — (chat_id, url, payload, context) — и ждёт всю пачку.
+
+        on_result(chat_id, context, status, text) вызывается в вызывающем потоке
+        по мере ответов; status None — запрос не удался (сеть, таймаут). Цикл
+        отправки сам ничего не обрабатывает: медленный on_result (например,
+        запись в полную очередь БД) не задерживает остальные запросы.
+        """
+        if not jobs:
+            return
+        results = queue.SimpleQueue()
+        sending = asyncio.run_coroutine_threadsafe(self._send_all(jobs, results), self.loop)
+        remaining = len(jobs)
+        while remaining:
+            try:
+                chat_id, context, status, text = results.get(timeout=1)
+            except queue.Empty:
+                if not sending.done():
+                    continue
+                # Отправка закончилась: всё, что она успела положить, уже в очереди
+                try:
+                    chat_id, context, status, text = results.get_nowait()
+                except queue.Empty:
+                    break
+            remaining -= 1
+            try:
+                on_result(chat_id, context, status, text)
+            except Exception as e:
+                logging.error(f"[ERROR] Обработка ответа для чата {chat_id}: {e}")
+        sending.result()
+
+
+def _retry_after(text):
+    """retry_after из ответа 429; тело не JSON или без параметра — 1 с"""
+    try:
+        body = json.loads(text)
+        return float(body["parameters"]["retry_after"])
+    except (ValueError, TypeError, KeyError):
+        return 1.0
+
+
+_delivery = None
+_delivery_lock = threading.Lock()
+
+
+def get_delivery():
+    """Поток отправки процесса; запускается при первом обращении"""
+    global _delivery
+    if _delivery is None:
+        with _delivery_lock:
+            if _delivery is None:
+                delivery = TelegramDelivery()
+                delivery.start()
+                _delivery = delivery
+    return _delivery
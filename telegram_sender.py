@@ -1,13 +1,18 @@
 # -*- coding: utf-8 -*-
-import sqlite3
-import math
-import requests
 import os
-from datetime import datetime, timedelta
+import time
+from datetime import datetime
 from zoneinfo import ZoneInfo
 from urllib.parse import quote, quote_plus
 from dotenv import load_dotenv
 
+from metrics import timer
+from matching import CompiledUsers
+from telegram_delivery import get_delivery
+from storage import (connect, release, write, execute_write, get_meta, set_meta, pair_placeholders,
+                     NEW_LISTINGS_QUERY, LISTINGS_BY_KEYS_QUERY, SENT_FOR_KEYS_QUERY,
+                     SOURCE_CODES, SQL_MAX_VARIABLES)
+
 # === Load environment ===
 load_dotenv()
 
@@ -15,240 +20,216 @@ BOT_TOKEN = os.getenv("TELEGRAM_SENDER_TOKEN", "CHANGE_ME")
 TELEGRAM_API_URL = f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage"
 TELEGRAM_MEDIA_GROUP_URL = f"https://api.telegram.org/bot{BOT_TOKEN}/sendMediaGroup"
 BERLIN_TZ = ZoneInfo("Europe/Berlin")
+# Сколько сек держим записи об отправке после начала окна last_run
+SENT_RETENTION_GRACE = int(os.getenv("SENT_RETENTION_GRACE", str(24 * 3600)))
+# Окно новых объявлений начинаем на столько сек раньше last_run: объявление другого узла
+# с created_at до прошлого опроса могло закоммититься уже после него. Повторно оно
+# не уйдёт — его отсекут записи об отправке
+WINDOW_OVERLAP = int(os.getenv("DELIVERY_WINDOW_OVERLAP", "120"))
 
+IMMOSCOUT = SOURCE_CODES["Immoscout"]
+KLEINANZEIGEN = SOURCE_CODES["Kleinanzeigen"]
+IMMOWELT = SOURCE_CODES["Immowelt"]
+INBERLINWOHNEN = SOURCE_CODES["InBerlinWohnen"]
+
+# Разобранные фильтры пользователей живут между запусками, пока не изменится таблица users
+compiled_users = CompiledUsers()
+
+SOURCE_LABELS = {
+    IMMOSCOUT: "ImmobilienScout24",
+    IMMOWELT: "Immowelt",
+    KLEINANZEIGEN: "Kleinanzeigen",
+    INBERLINWOHNEN: "InBerlinWohnen",
+}
 
-def calculate_distance(lat1, lon1, lat2, lon2):
-    """Вычисление расстояния между координатами (метры)."""
-    R = 6371000
-    lat1_rad, lon1_rad = math.radians(lat1), math.radians(lon1)
-    lat2_rad, lon2_rad = math.radians(lat2), math.radians(lon2)
-    dlat = lat2_rad - lat1_rad
-    dlon = lon2_rad - lon1_rad
-    a = math.sin(dlat / 2) ** 2 + math.cos(lat1_rad) * math.cos(lat2_rad) * math.sin(dlon / 2) ** 2
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
-    return R * c
-
-
-def point_in_polygon(lat, lon, polygon):
-    """Проверка, входит ли точка в полигон."""
-    inside = False
-    n = len(polygon)
-    j = n - 1
-    for i in range(n):
-        lat_i, lon_i = polygon[i]
-        lat_j, lon_j = polygon[j]
-        if ((lon_i > lon) != (lon_j > lon)):
-            slope = (lat_j - lat_i) / (lon_j - lon_i + 1e-15)
-            intersect_lat = slope * (lon - lon_i) + lat_i
-            if lat < intersect_lat:
-                inside = not inside
-        j = i
-    return inside
-
-
-def parse_location(location_str):
-    """Парсинг строки локации (circle / polygon)."""
-    if not location_str:
-        return None, None
-    if ";" in location_str:
-        points = [p.strip() for p in location_str.split(";") if p.strip()]
-        polygon = [(float(p.split(",")[0]), float(p.split(",")[1])) for p in points]
-        return ("polygon", polygon) if len(polygon) >= 3 else (None, None)
-    else:
-        parts = location_str.split(",")
-        if len(parts) == 3:
-            lat, lon, radius = map(lambda x: float(x.strip()), parts)
-            return "circle", (lat, lon, radius)
-        return None, None
+
+def mark_delivered_until(moment):
+    """Сдвигает окно last_run: всё, что сохранено раньше moment (UTC epoch), уже разослано потоком."""
+    write(set_meta, 'last_run', int(moment))
 
 
 def send_matching_listings():
     """Основная функция отправки новых объявлений."""
     print("📬 Новые объявления найдены! Отправляем пользователям...")
-    conn = sqlite3.connect("seen_ids.db")
+    conn = connect()
     cursor = conn.cursor()
 
-    # Метаданные
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS run_metadata (
-            key TEXT PRIMARY KEY,
-            value TEXT
-        )
-    """)
-    cursor.execute("SELECT value FROM run_metadata WHERE key = 'last_run'")
-    row = cursor.fetchone()
-    MIN_CREATED_TIME = datetime.now(BERLIN_TZ) - timedelta(minutes=5) if not row else datetime.fromisoformat(row[0])
-    NOW = datetime.now(BERLIN_TZ)
-    cursor.execute("INSERT OR REPLACE INTO run_metadata (key, value) VALUES (?, ?)",
-                   ('last_run', NOW.isoformat(timespec="seconds")))
-
-    # Отправленные объявления
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS sent_listings (
-            user_id INTEGER,
-            listing_id TEXT,
-            url TEXT,
-            sent_at TEXT,
-            PRIMARY KEY (user_id, listing_id)
-        )
-    """)
-
-    # Все новые объявления
-    cursor.execute("""
-        SELECT id, url, price, price_warm, size, address, lat, lon, created_at, 
-               swapflat, wbs_required, source_immoscout, source_kleinanzeigen, 
-               source_immowelt, source_inberlinwohnen, photo_url
-        FROM listings
-        WHERE created_at >= ?
-    """, (MIN_CREATED_TIME.isoformat(timespec="seconds"),))
+    last_run = get_meta(cursor, 'last_run')
+    NOW = int(time.time())
+    MIN_CREATED_TIME = NOW - 5 * 60 if not last_run else int(last_run) - WINDOW_OVERLAP
+
+    # Все новые объявления: created_at >= MIN_CREATED_TIME, диапазон по индексу
+    cursor.execute(NEW_LISTINGS_QUERY, (MIN_CREATED_TIME,))
     listings = cursor.fetchall()
 
-    # Пользователи
-    cursor.execute("""
-        SELECT id, location, min_price, max_price, min_size, max_size, 
-               subscribed_until, is_searching,
-               tauschwohnung, wbs,
-               use_immoscout, use_kleinanzeigen, use_immowelt, use_inberlinwohnen
-        FROM users
-        WHERE IFNULL(is_searching, 0) = 1
-    """)
-    users = cursor.fetchall()
+    total_sent = deliver(cursor, listings)
+    release(conn)
+    write(set_meta, 'last_run', NOW)
+    print(f"[INFO] Завершено: Отправлено {total_sent} новых объявлений.")
 
-    cursor.execute("SELECT user_id, listing_id FROM sent_listings")
-    sent_records = set(cursor.fetchall())
 
-    total_sent = 0
+def send_listings(keys):
+    """Рассылает конкретные только что сохранённые объявления (потоковый режим).
 
-    for user in users:
-        try:
-            (user_id, location, min_price, max_price, min_size, max_size,
-             subscribed_until, is_searching,
-             tauschwohnung, wbs,
-             use_immoscout, use_kleinanzeigen, use_immowelt, use_inberlinwohnen) = user
-
-            # Проверка подписки
-            if subscribed_until:
-                expiry = datetime.fromisoformat(subscribed_until).replace(tzinfo=BERLIN_TZ)
-                if expiry < datetime.now(BERLIN_TZ):
-                    cursor.execute("UPDATE users SET is_searching = 0 WHERE id = ?", (user_id,))
-                    conn.commit()
-                    print(f"[SUBSCRIPTION] 🔕 User {user_id} — подписка истекла, поиск отключён")
-                    continue
-
-            loc_type, loc_data = parse_location(location)
-            if loc_type is None:
-                continue
-
-            if loc_type == "circle":
-                lat_u, lon_u, radius_u = loc_data
-            else:
-                polygon = loc_data
+    keys — пары (код источника, ID).
+    """
+    if not keys:
+        return 0
+    conn = connect()
+    cursor = conn.cursor()
 
-        except Exception as e:
-            print(f"[USER ERROR] User {user_id}: {e}")
+    cursor.execute(LISTINGS_BY_KEYS_QUERY.format(pairs=pair_placeholders(len(keys))),
+                   [value for key in keys for value in key])
+    listings = cursor.fetchall()
+
+    total_sent = deliver(cursor, listings)
+    release(conn)
+    print(f"[INFO] Поток: {len(listings)} объявлений, отправлено {total_sent} сообщений.")
+    return total_sent
+
+
+def load_sent_records(cursor, listings):
+    """(user_id, source, listing_id) уже отправленных — только для этих объявлений."""
+    sent_records = set()
+    step = SQL_MAX_VARIABLES // 2
+    for i in range(0, len(listings), step):
+        chunk = listings[i:i + step]
+        cursor.execute(SENT_FOR_KEYS_QUERY.format(pairs=pair_placeholders(len(chunk))),
+                       [value for listing in chunk for value in listing[:2]])
+        sent_records.update(cursor.fetchall())
+    return sent_records
+
+
+def expire_sent_records():
+    """Удаляет записи об отправке, которые уже не понадобятся для проверки дублей.
+
+    Только по возрасту: запись отправлена раньше окна last_run (с запасом
+    SENT_RETENTION_GRACE), и объявление, если оно ещё в базе, создано тогда же.
+    Отсутствие объявления само по себе не повод: очистка удаляет и временно
+    недоступные, а парсер сохранит их заново — запись не даст разослать повторно.
+    """
+    conn = connect()
+    cursor = conn.cursor()
+    last_run = get_meta(cursor, 'last_run')
+    release(conn)
+    cutoff = (int(last_run) if last_run else int(time.time())) - SENT_RETENTION_GRACE
+    # sent_at — ISO-строка по берлинскому времени, сравниваем в том же формате
+    cutoff_text = datetime.fromtimestamp(cutoff, BERLIN_TZ).isoformat(timespec="seconds")
+    expired = execute_write("""
+        DELETE FROM sent_listings
+        WHERE sent_at < ?
+          AND NOT EXISTS (
+            SELECT 1 FROM listings
+            WHERE listings.source = sent_listings.source
+              AND listings.id = sent_listings.listing_id
+              AND listings.created_at >= ?
+        )
+    """, (cutoff_text, cutoff)).result()
+    if expired:
+        print(f"[INFO] Удалено {expired} устаревших записей об отправке.")
+    return expired
+
+
+def find_matches(index, listings, sent_records):
+    """Возвращает пары (user_id, listing), которые подходят под фильтры и ещё не отправлялись."""
+    matches = []
+    for user_filter, listing in index.match(listings):
+        if (user_filter.user_id, listing[0], listing[1]) in sent_records:
             continue
+        matches.append((user_filter.user_id, listing))
+    return matches
 
-        for listing in listings:
-            try:
-                (listing_id, url, price, price_warm, size, address, lat_l, lon_l,
-                 created_at, swapflat, wbs_required,
-                 source_immoscout, source_kleinanzeigen, source_immowelt, source_inberlinwohnen,
-                 photo_url) = listing
-
-                # Проверка условий
-                if (user_id, listing_id) in sent_records:
-                    continue
-                if None in (price, size, lat_l, lon_l, created_at):
-                    continue
-                if source_immoscout and not use_immoscout:
-                    continue
-                if source_kleinanzeigen and not use_kleinanzeigen:
-                    continue
-                if source_immowelt and not use_immowelt:
-                    continue
-                if source_inberlinwohnen and not use_inberlinwohnen:
-                    continue
-                if tauschwohnung == 0 and swapflat == 1:
-                    continue
-                if wbs == 0 and wbs_required == 1:
-                    continue
-                if min_price and price < min_price:
-                    continue
-                if max_price and price > max_price:
-                    continue
-                if min_size and size < min_size:
-                    continue
-                if max_size and size > max_size:
-                    continue
-                if loc_type == "circle" and calculate_distance(lat_u, lon_u, lat_l, lon_l) > radius_u:
-                    continue
-                if loc_type == "polygon" and not point_in_polygon(lat_l, lon_l, polygon):
-                    continue
-
-                # Определяем источник
-                if source_immoscout:
-                    source_str = "ImmobilienScout24"
-                elif source_immowelt:
-                    source_str = "Immowelt"
-                elif source_kleinanzeigen:
-                    source_str = "Kleinanzeigen"
-                elif source_inberlinwohnen:
-                    source_str = "InBerlinWohnen"
-                else:
-                    source_str = "Listing"
-
-                address_encoded = quote_plus(address)
-                google_maps_url = f"https://www.google.com/maps/search/?api=1&query={address_encoded}"
-                url_encoded = quote(url, safe=":/")
-
-                if not price_warm or price_warm == price:
-                    price_text = f"💰 <b>Price:</b> {price} €"
-                elif price_warm > price:
-                    price_text = f"💰 <b>Kaltmiete:</b> {price} € | <b>Warmmiete:</b> {price_warm} €"
-                else:
-                    price_text = f"💰 <b>Price:</b> {price} €"
-
-                message = (
-                    f"🏠 <b>New Flat for You!</b>\n"
-                    f"{price_text}\n"
-                    f"📏 <b>Size:</b> {size} m²\n"
-                    f"🔗 <a href='{url_encoded}'>{source_str} Link</a>\n"
-                    f"📍 <a href='{google_maps_url}'>{address}</a>"
-                )
-
-                # Отправка фото/сообщения
-                photo_urls = [u.strip() for u in (photo_url or '').split(',') if u.strip()]
-                if photo_urls:
-                    media = []
-                    for i, img_url in enumerate(photo_urls[:10]):
-                        media.append({
-                            "type": "photo",
-                            "media": img_url,
-                            "caption": message if i == 0 else "",
-                            "parse_mode": "HTML"
-                        })
-                    payload = {"chat_id": user_id, "media": media}
-                    response = requests.post(TELEGRAM_MEDIA_GROUP_URL, json=payload)
-                else:
-                    payload = {"chat_id": user_id, "text": message, "parse_mode": "HTML"}
-                    response = requests.post(TELEGRAM_API_URL, json=payload)
-
-                if response.status_code == 200:
-                    total_sent += 1
-                    cursor.execute(
-                        "INSERT INTO sent_listings (user_id, listing_id, url, sent_at) VALUES (?, ?, ?, ?)",
-                        (user_id, listing_id, url, datetime.now(BERLIN_TZ).isoformat(timespec="seconds"))
-                    )
-                    conn.commit()
-                else:
-                    print(f"❌ Ошибка отправки пользователю {user_id}: {response.status_code}, {response.text}")
-
-            except Exception as e:
-                print(f"[ERROR] Внутри цикла listings: {e}")
-                continue
-
-    conn.close()
-    print(f"[INFO] Завершено: Отправлено {total_sent} новых объявлений.")
+
+def format_message(listing):
+    """Текст сообщения об объявлении (HTML)."""
+    (source, listing_id, url, price, price_warm, size, address, lat_l, lon_l,
+     created_at, swapflat, wbs_required, photo_url) = listing
+
+    source_str = SOURCE_LABELS.get(source, "Listing")
+
+    address_encoded = quote_plus(address)
+    google_maps_url = f"https://www.google.com/maps/search/?api=1&query={address_encoded}"
+    url_encoded = quote(url, safe=":/")
+
+    if not price_warm or price_warm == price:
+        price_text = f"💰 <b>Price:</b> {price} €"
+    elif price_warm > price:
+        price_text = f"💰 <b>Kaltmiete:</b> {price} € | <b>Warmmiete:</b> {price_warm} €"
+    else:
+        price_text = f"💰 <b>Price:</b> {price} €"
+
+    return (
+        f"🏠 <b>New Flat for You!</b>\n"
+        f"{price_text}\n"
+        f"📏 <b>Size:</b> {size} m²\n"
+        f"🔗 <a href='{url_encoded}'>{source_str} Link</a>\n"
+        f"📍 <a href='{google_maps_url}'>{address}</a>"
+    )
+
+
+def build_request(user_id, listing):
+    """URL и тело запроса Bot API: альбом из фото с подписью или просто сообщение."""
+    message = format_message(listing)
+    photo_url = listing[12]
+    photo_urls = [u.strip() for u in (photo_url or '').split(',') if u.strip()]
+    if photo_urls:
+        media = []
+        for i, img_url in enumerate(photo_urls[:10]):
+            media.append({
+                "type": "photo",
+                "media": img_url,
+                "caption": message if i == 0 else "",
+                "parse_mode": "HTML"
+            })
+        return TELEGRAM_MEDIA_GROUP_URL, {"chat_id": user_id, "media": media}
+    return TELEGRAM_API_URL, {"chat_id": user_id, "text": message, "parse_mode": "HTML"}
+
+
+def deliver(cursor, listings):
+    """Сопоставляет объявления с фильтрами пользователей и отправляет совпадения."""
+    # Пользователи: из кэша; у кого подписка истекла — отключаем поиск
+    index, expired = compiled_users.get(cursor)
+    for user_id in expired:
+        execute_write("UPDATE users SET is_searching = 0 WHERE id = ?", (user_id,))
+        print(f"[SUBSCRIPTION] 🔕 User {user_id} — подписка истекла, поиск отключён")
+
+    sent_records = load_sent_records(cursor, listings)
+
+    with timer("matching", "Sender"):
+        matches = find_matches(index, listings, sent_records)
+
+    jobs = []
+    for user_id, listing in matches:
+        try:
+            url, payload = build_request(user_id, listing)
+            jobs.append((user_id, url, payload, listing))
+        except Exception as e:
+            print(f"[ERROR] Отправка пользователю {user_id}: {e}")
+
+    pending = []
+
+    def on_result(user_id, listing, status, text):
+        # Отметку ставим сразу после ответа: упавшая на середине пачка не разошлёт её повторно
+        if status == 200:
+            source, listing_id, url = listing[:3]
+            pending.append((user_id, execute_write(
+                "INSERT INTO sent_listings (user_id, source, listing_id, url, sent_at) VALUES (?, ?, ?, ?, ?)",
+                (user_id, source, listing_id, url, datetime.now(BERLIN_TZ).isoformat(timespec="seconds"))
+            )))
+        else:
+            print(f"❌ Ошибка отправки пользователю {user_id}: {status}, {text}")
+
+    with timer("delivery", "Sender"):
+        get_delivery().send_all(jobs, on_result)
+
+    # Отметки об отправке должны лечь в базу до следующей пачки — иначе она их не увидит
+    for user_id, future in pending:
+        try:
+            future.result()
+        except Exception as e:
+            print(f"[ERROR] Отметка об отправке пользователю {user_id}: {e}")
+
+    return len(pending)
 
 
 def run():